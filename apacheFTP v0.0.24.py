@@ -1,51 +1,630 @@
 import http.server
 import socketserver
-from urllib.parse import urlparse, parse_qs, unquote
-import os, hashlib, secrets
+from urllib.parse import urlparse, parse_qs, unquote, urlencode
+from html import escape
+import os, hashlib, hmac, secrets, base64
+import json, sqlite3
+from collections import OrderedDict
+import signal, time, threading, traceback
+import io, asyncio, argparse, sys, logging, tempfile
+from concurrent.futures import ThreadPoolExecutor
+import multiprocessing
 from http import cookies
 
+
+from comun import (ManejadorBase, ServidorPoolHilos, prefork, TIEMPO_INACTIVO, MAX_PETICIONES_CONEXION,
+                   Comprimidos, CacheBytes, ListadoCarpetas, CatalogoArchivos, IndicePublicados, dentro_de,
+                   CacheRevalidada, USUARIOS_POR_PAGINA, CONSULTAS_MAX,
+                   HILOS_POOL, COLA_POOL, PILA_HILO_KB)
+
 WEB_ROOT = os.path.abspath(os.path.dirname(__file__))
 USERS_FILE = os.path.join(WEB_ROOT, "usuarios.txt")
+CUENTAS_DIR = os.path.join(WEB_ROOT, "cuentas")  # usuarios y contraseñas (SQLite); usuarios.txt se migra aquí
 USERS_BASE = os.path.join(WEB_ROOT, "usuarios")
 os.makedirs(USERS_BASE, exist_ok=True)
-SESSIONS = {}
+# En modo pre-fork las sesiones se guardan en disco para que las vean todos los workers
+SESSIONS_DIR = os.path.join(WEB_ROOT, "sesiones")
+SESIONES_COMPARTIDAS = False
+SESION_INACTIVA = 30 * 60     # segundos sin uso tras los que caduca una sesión
+SESION_MAXIMA = 12 * 3600     # segundos de vida de una sesión aunque se siga usando
+MAX_SESIONES = 100000         # sesiones guardadas como mucho (se expulsan las menos usadas)
+SESION_LIMPIEZA = 60          # segundos entre pasadas del limpiador de sesiones
+FRANJAS_SESIONES = 16         # locks independientes entre los que se reparten las sesiones
+# Sesiones firmadas: la cookie lleva usuario y caducidad con HMAC y cualquier proceso o nodo la verifica
+SESIONES_FIRMADAS = False
+CLAVES_REFRESCO = 5           # segundos entre comprobaciones del archivo de claves de sesión
+CLAVE_SESION_BYTES = 32       # bytes de cada clave HMAC de sesión (el doble de dígitos hexadecimales)
+REVOCACION_REFRESCO = 2       # segundos entre lecturas de las revocaciones hechas por otros procesos
+# Variantes comprimidas (gzip/brotli) de los archivos publicados, con el mtime del original
+COMPRIMIDOS_DIR = os.path.join(WEB_ROOT, "comprimidos")
+CATALOGO_DIR = os.path.join(WEB_ROOT, "catalogo")  # catálogo SQLite de archivos de usuarios
+CACHE_MAX_BYTES = 64 * 1024 * 1024   # memoria total para páginas publicadas en caché
+CACHE_MAX_ENTRADA = 1024 * 1024      # las respuestas más grandes se envían desde disco
+MAX_HILOS_IO = 32            # hilos para E/S bloqueante en el motor async
+BLOQUE_ASYNC = 1024 * 1024   # motor async: bytes por llamada a sendfile (cada una con TIEMPO_INACTIVO de plazo)
+RUTAS_BUCLE = {b"/", b"/login", b"/nuevo_usuario"}  # motor async: GET que se contestan sin salir del bucle
+MAX_CABECERAS = 64 * 1024    # tamaño máximo de línea de petición + cabeceras
+HASH_N = 2 ** 14             # scrypt: coste en CPU y memoria del hash de contraseñas
+HASH_R = 8
+HASH_P = 1
+HASH_PROCESOS = 2            # procesos que calculan hashes de contraseña (0 = en el propio hilo)
+HASH_PENDIENTES = 32         # hashes en cola o en curso antes de responder 503
+HASH_ESPERA = 5              # segundos máximos (en total) esperando hueco y resultado del pool de hash
+CACHE_SERVIDORES_TTL = 30    # /servidores: segundos que una página generada se sirve sin rehacerla
+LISTADOS_MAX = 1024          # carpetas cuyo listado se guarda en memoria
+
+REGISTRO = logging.getLogger("apacheFTP")
 
 def hash_password(pwd):
-    return hashlib.sha256(pwd.encode()).hexdigest()
+    """Hash scrypt con sal aleatoria, guardado como scrypt$n$r$p$sal$clave."""
+    sal = secrets.token_bytes(16)
+    clave = hashlib.scrypt(pwd.encode(), salt=sal, n=HASH_N, r=HASH_R, p=HASH_P,
+                           maxmem=256 * HASH_N * HASH_R * HASH_P, dklen=32)
+    return f"scrypt${HASH_N}${HASH_R}${HASH_P}${sal.hex()}${clave.hex()}"
+
+def verificar_password(pwd, guardado):
+    """(correcta, hash nuevo o None).
+
+    Acepta también los SHA-256 sin sal de antes; si la contraseña es correcta
+    y el hash es de ese tipo (o scrypt con otros parámetros), devuelve el
+    hash actual para guardarlo en su lugar. Un registro scrypt mal formado
+    cuenta como contraseña incorrecta.
+    """
+    if guardado.startswith("scrypt$"):
+        try:
+            _, n, r, p, sal, clave = guardado.split("$")
+            n, r, p = int(n), int(r), int(p)
+            esperada = bytes.fromhex(clave)
+            calculada = hashlib.scrypt(pwd.encode(), salt=bytes.fromhex(sal), n=n, r=r, p=p,
+                                       maxmem=256 * n * r * p, dklen=len(esperada))
+        except (ValueError, OverflowError) as e:
+            REGISTRO.warning("Hash scrypt mal formado: %s", e)
+            return False, None
+        correcta = hmac.compare_digest(calculada, esperada)
+        vigente = (n, r, p) == (HASH_N, HASH_R, HASH_P)
+    else:
+        correcta = hmac.compare_digest(hashlib.sha256(pwd.encode()).hexdigest(), guardado)
+        vigente = False
+    return correcta, (hash_password(pwd) if correcta and not vigente else None)
+
+class HashOcupado(Exception):
+    """El pool de hash no tiene hueco (o no responde) en HASH_ESPERA segundos."""
+
+def iniciar_proceso_hash():
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+class PoolHash:
+    """Procesos que calculan los hash de contraseña fuera de los hilos que sirven.
+
+    scrypt es caro a propósito: en procesos aparte, una ráfaga de logins no
+    retiene el GIL del resto de rutas. Admite como mucho pendientes trabajos
+    (en cola o en curso): el hueco se libera cuando el trabajo termina, no
+    cuando quien lo pidió deja de esperar. Quien no consigue hueco y
+    resultado dentro del mismo plazo de espera segundos recibe HashOcupado.
+    """
+    def __init__(self, procesos, pendientes=HASH_PENDIENTES, espera=HASH_ESPERA):
+        self.procesos = procesos
+        self.espera = espera
+        self.pendientes = threading.BoundedSemaphore(pendientes)
+        self.pool = None
+        self.lock = threading.Lock()
+
+    def arrancar(self):
+        with self.lock:
+            if self.pool is None:
+                self.pool = multiprocessing.get_context("fork").Pool(
+                    self.procesos, initializer=iniciar_proceso_hash)
+            return self.pool
+
+    def liberar(self, _resultado):
+        self.pendientes.release()
+
+    def ejecutar(self, funcion, *args):
+        limite = time.monotonic() + self.espera
+        if not self.pendientes.acquire(timeout=self.espera):
+            raise HashOcupado("demasiados inicios de sesión a la vez")
+        try:
+            pendiente = self.arrancar().apply_async(
+                funcion, args, callback=self.liberar, error_callback=self.liberar)
+        except BaseException:
+            self.pendientes.release()
+            raise
+        try:
+            return pendiente.get(max(0, limite - time.monotonic()))
+        except multiprocessing.TimeoutError:
+            raise HashOcupado("el cálculo de la contraseña tarda demasiado")
+
+POOL_HASH = None  # se crea al arrancar si se piden procesos de hash
+
+def en_pool_hash(funcion, *args):
+    """Ejecuta funcion en POOL_HASH si está activo; si no, en el hilo actual."""
+    if POOL_HASH is None:
+        return funcion(*args)
+    return POOL_HASH.ejecutar(funcion, *args)
+
+class AlmacenUsuarios:
+    """Usuarios y hashes de contraseña en SQLite, buscados por clave primaria.
+
+    La primera vez que se abre importa el antiguo usuarios.txt (si existe) y
+    lo aparta a CUENTAS_DIR para no volver a importarlo. El alta es un único
+    INSERT que no hace nada si el usuario ya existe, así que dos registros
+    simultáneos del mismo nombre no se pisan. Cada proceso abre su conexión
+    (los workers del pre-fork comparten el archivo en modo WAL).
+    """
+    def __init__(self, ruta, archivo_antiguo):
+        self.ruta = ruta
+        self.archivo_antiguo = archivo_antiguo
+        self.conexion = None
+        self.lock = threading.Lock()
+        os.register_at_fork(after_in_child=self.tras_fork)
+
+    def tras_fork(self):
+        self.conexion = None
+        self.lock = threading.Lock()
+
+    def abrir(self):
+        # Llamar con self.lock tomado
+        if self.conexion is None:
+            os.makedirs(os.path.dirname(self.ruta), exist_ok=True)
+            db = sqlite3.connect(self.ruta, timeout=30, check_same_thread=False, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("CREATE TABLE IF NOT EXISTS usuarios (nombre TEXT PRIMARY KEY, hash TEXT NOT NULL)")
+            self.migrar(db)
+            self.conexion = db
+        return self.conexion
 
-def cargar_usuarios():
-    usuarios = {}
-    if os.path.exists(USERS_FILE):
-        with open(USERS_FILE, "r", encoding="utf-8") as f:
-            for line in f:
+    def migrar(self, db):
+        """Importa usuarios.txt (línea usuario:hash; si se repite, vale la última).
+
+        Todo ocurre dentro de una transacción BEGIN IMMEDIATE, que toma el
+        lock de escritura de la base de datos: si varios workers del pre-fork
+        abren a la vez, el primero importa y aparta el archivo y los demás,
+        al conseguir el lock, ya no lo encuentran.
+        """
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            try:
+                with open(self.archivo_antiguo, "r", encoding="utf-8") as f:
+                    lineas = f.readlines()
+            except FileNotFoundError:
+                db.execute("COMMIT")
+                return
+            usuarios = {}
+            for line in lineas:
                 line = line.strip()
                 if ":" not in line: continue
                 user, pwdhash = line.split(":", 1)
                 usuarios[user] = pwdhash
-    return usuarios
+            # INSERT OR IGNORE: quien ya se registró en la base de datos no se pisa
+            db.executemany("INSERT OR IGNORE INTO usuarios VALUES (?, ?)", usuarios.items())
+            migrado = os.path.join(os.path.dirname(self.ruta), "usuarios.txt.migrado")
+            os.replace(self.archivo_antiguo, migrado)
+            try:
+                db.execute("COMMIT")
+            except BaseException:
+                os.replace(migrado, self.archivo_antiguo)
+                raise
+        except BaseException:
+            if db.in_transaction:
+                db.execute("ROLLBACK")
+            raise
+        REGISTRO.info("Migrados %d usuarios de %s a %s", len(usuarios), self.archivo_antiguo, self.ruta)
+
+    def buscar(self, nombre):
+        """Hash de la contraseña de nombre, o None si no existe."""
+        with self.lock:
+            fila = self.abrir().execute("SELECT hash FROM usuarios WHERE nombre = ?", (nombre,)).fetchone()
+        return fila[0] if fila else None
+
+    def actualizar(self, nombre, anterior, nuevo):
+        """Cambia el hash de nombre solo si sigue siendo anterior."""
+        with self.lock:
+            self.abrir().execute("UPDATE usuarios SET hash = ? WHERE nombre = ? AND hash = ?",
+                                 (nuevo, nombre, anterior))
+
+    def crear(self, nombre, pwdhash):
+        """Da de alta el usuario; False si ya existía."""
+        with self.lock:
+            cursor = self.abrir().execute("INSERT OR IGNORE INTO usuarios VALUES (?, ?)", (nombre, pwdhash))
+        return cursor.rowcount == 1
+
+USUARIOS = AlmacenUsuarios(os.path.join(CUENTAS_DIR, "usuarios.sqlite3"), USERS_FILE)
 
 def guardar_usuario(user, pwd):
-    with open(USERS_FILE, "a", encoding="utf-8") as f:
-        f.write(f"{user}:{hash_password(pwd)}\n")
+    """Registra user; False si ya existe."""
+    if USUARIOS.buscar(user) is not None:
+        return False
+    return USUARIOS.crear(user, en_pool_hash(hash_password, pwd))
+
+def comprobar_usuario(user, pwd):
+    """True si pwd es la contraseña de user; de paso rehace su hash si era de los antiguos."""
+    guardado = USUARIOS.buscar(user)
+    if guardado is None:
+        return False
+    correcta, nuevo = en_pool_hash(verificar_password, pwd, guardado)
+    if nuevo:
+        USUARIOS.actualizar(user, guardado, nuevo)
+    return correcta
 
 def crear_carpeta_usuario(username):
     user_dir = os.path.join(USERS_BASE, username)
     os.makedirs(user_dir, exist_ok=True)
     return user_dir
 
+class AlmacenSesiones:
+    """Sesiones en memoria con caducidad por inactividad y absoluta, y tope LRU.
+
+    Se reparten en franjas según el sid, cada una con su lock y su
+    OrderedDict ordenado por último uso: los hilos que consultan sesiones
+    distintas casi nunca se esperan entre sí. Cada franja guarda como mucho
+    max_sesiones / franjas y, si se llena, expulsa la que lleva más tiempo
+    sin usarse. limpiar() quita las caducadas.
+    """
+    def __init__(self, max_sesiones, inactiva, maxima, franjas=FRANJAS_SESIONES):
+        self.max_franja = max(1, -(-max_sesiones // franjas))
+        self.inactiva = inactiva
+        self.maxima = maxima
+        self.franjas = [(threading.Lock(), OrderedDict()) for _ in range(franjas)]
+        os.register_at_fork(after_in_child=self.tras_fork)
+
+    def tras_fork(self):
+        self.franjas = [(threading.Lock(), sesiones) for _, sesiones in self.franjas]
+
+    def franja(self, sid):
+        return self.franjas[hash(sid) % len(self.franjas)]
+
+    def caducada(self, datos, ahora):
+        _, creada, usada = datos
+        return ahora - usada > self.inactiva or ahora - creada > self.maxima
+
+    def crear(self, sid, user):
+        ahora = time.monotonic()
+        lock, sesiones = self.franja(sid)
+        with lock:
+            sesiones[sid] = [user, ahora, ahora]
+            while len(sesiones) > self.max_franja:
+                sesiones.popitem(last=False)
+
+    def buscar(self, sid):
+        ahora = time.monotonic()
+        lock, sesiones = self.franja(sid)
+        with lock:
+            datos = sesiones.get(sid)
+            if datos is None:
+                return None
+            if self.caducada(datos, ahora):
+                del sesiones[sid]
+                return None
+            datos[2] = ahora
+            sesiones.move_to_end(sid)
+            return datos[0]
+
+    def borrar(self, sid):
+        lock, sesiones = self.franja(sid)
+        with lock:
+            sesiones.pop(sid, None)
+
+    def limpiar(self):
+        ahora = time.monotonic()
+        for lock, sesiones in self.franjas:
+            with lock:
+                for sid in [sid for sid, datos in sesiones.items() if self.caducada(datos, ahora)]:
+                    del sesiones[sid]
+
+    def __len__(self):
+        return sum(len(sesiones) for _, sesiones in self.franjas)
+
+SESSIONS = AlmacenSesiones(MAX_SESIONES, SESION_INACTIVA, SESION_MAXIMA)
+
+def b64_codificar(datos):
+    return base64.urlsafe_b64encode(datos).rstrip(b"=").decode("ascii")
+
+def b64_decodificar(texto):
+    return base64.urlsafe_b64decode(texto + "=" * (-len(texto) % 4))
+
+class ClavesSesion:
+    """Claves HMAC de las cookies de sesión firmadas, una por línea en hexadecimal.
+
+    La primera firma las cookies nuevas; todas sirven para verificar. Para
+    rotar se añade una clave nueva al principio (--rotar-clave-sesion) y la
+    antigua se quita cuando ya han caducado sus cookies (SESION_MAXIMA). El
+    archivo se vuelve a leer si cambia su mtime, como mucho cada
+    CLAVES_REFRESCO segundos; con varios nodos, todos deben tener el mismo.
+    """
+    def __init__(self, ruta):
+        self.ruta = ruta
+        self.claves = []       # [(id, clave)], la primera es la activa
+        self.mtime = None
+        self.leida = 0
+        self.lock = threading.Lock()
+        os.register_at_fork(after_in_child=self.tras_fork)
+
+    def tras_fork(self):
+        self.lock = threading.Lock()
+
+    def leer(self):
+        """Claves válidas del archivo, en orden; las líneas mal formadas se saltan."""
+        try:
+            with open(self.ruta, "r", encoding="utf-8", errors="replace") as f:
+                lineas = [linea.strip() for linea in f if linea.strip()]
+        except FileNotFoundError:
+            return []
+        claves = []
+        for numero, linea in enumerate(lineas, 1):
+            try:
+                valida = len(bytes.fromhex(linea)) == CLAVE_SESION_BYTES
+            except ValueError:
+                valida = False
+            if valida:
+                claves.append(linea)
+            else:
+                REGISTRO.warning("Clave de sesión %d mal formada en %s; se ignora", numero, self.ruta)
+        return claves
+
+    def refrescar(self):
+        if self.claves and time.monotonic() - self.leida < CLAVES_REFRESCO:
+            return
+        with self.lock:
+            self.leida = time.monotonic()
+            try:
+                mtime = os.stat(self.ruta).st_mtime_ns
+            except FileNotFoundError:
+                mtime = None
+            if self.claves and mtime == self.mtime:
+                return
+            claves = self.leer()
+            if not claves:
+                # Sin archivo, vacío o sin ninguna clave válida: se genera una clave nueva
+                self.rotar()
+                claves = self.leer()
+                mtime = os.stat(self.ruta).st_mtime_ns
+            claves = [bytes.fromhex(clave) for clave in claves]
+            self.claves = [(hashlib.sha256(clave).hexdigest()[:8], clave) for clave in claves]
+            self.mtime = mtime
+
+    def rotar(self):
+        """Pone una clave nueva como activa, conservando las anteriores para verificar."""
+        carpeta = os.path.dirname(self.ruta)
+        os.makedirs(carpeta, exist_ok=True)
+        claves = [secrets.token_hex(CLAVE_SESION_BYTES)] + self.leer()
+        fd, tmp = tempfile.mkstemp(dir=carpeta, prefix=os.path.basename(self.ruta) + ".", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write("\n".join(claves) + "\n")
+            os.replace(tmp, self.ruta)
+        except BaseException:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            raise
+
+    def activa(self):
+        self.refrescar()
+        return self.claves[0]
+
+    def buscar(self, clave_id):
+        self.refrescar()
+        for id_, clave in self.claves:
+            if id_ == clave_id:
+                return clave
+        return None
+
+class RevocacionesSesion:
+    """Cookies firmadas que /logout ha invalidado antes de que caduquen.
+
+    Se guardan en SQLite para que las vean todos los workers y nodos que
+    comparten CUENTAS_DIR, y cada proceso tiene copia en memoria: verificar
+    una cookie no consulta la base de datos; solo se leen las revocaciones
+    nuevas cada REVOCACION_REFRESCO segundos. Las caducadas se borran al limpiar.
+    """
+    def __init__(self, ruta):
+        self.ruta = ruta
+        self.revocadas = {}    # jti -> expira (epoch)
+        self.ultima = 0        # id de la última revocación leída
+        self.leida = 0
+        self.conexion = None
+        self.lock = threading.Lock()
+        os.register_at_fork(after_in_child=self.tras_fork)
+
+    def tras_fork(self):
+        self.conexion = None
+        self.lock = threading.Lock()
+
+    def abrir(self):
+        # Llamar con self.lock tomado
+        if self.conexion is None:
+            os.makedirs(os.path.dirname(self.ruta), exist_ok=True)
+            self.conexion = sqlite3.connect(self.ruta, timeout=30, check_same_thread=False, isolation_level=None)
+            self.conexion.execute("PRAGMA journal_mode=WAL")
+            self.conexion.execute("CREATE TABLE IF NOT EXISTS revocadas ("
+                                  "id INTEGER PRIMARY KEY AUTOINCREMENT, jti TEXT UNIQUE, expira INTEGER)")
+        return self.conexion
+
+    def refrescar(self):
+        if time.monotonic() - self.leida < REVOCACION_REFRESCO:
+            return
+        with self.lock:
+            self.leida = time.monotonic()
+            filas = self.abrir().execute("SELECT id, jti, expira FROM revocadas WHERE id > ? ORDER BY id",
+                                         (self.ultima,)).fetchall()
+        for id_, jti, expira in filas:
+            self.revocadas[jti] = expira
+            self.ultima = id_
+
+    def revocar(self, jti, expira):
+        self.revocadas[jti] = expira
+        with self.lock:
+            self.abrir().execute("INSERT OR IGNORE INTO revocadas (jti, expira) VALUES (?, ?)", (jti, expira))
+
+    def contiene(self, jti):
+        self.refrescar()
+        return jti in self.revocadas
+
+    def limpiar(self):
+        ahora = time.time()
+        for jti in [jti for jti, expira in self.revocadas.items() if expira < ahora]:
+            self.revocadas.pop(jti, None)
+        with self.lock:
+            self.abrir().execute("DELETE FROM revocadas WHERE expira < ?", (ahora,))
+
+CLAVES_SESION = ClavesSesion(os.path.join(CUENTAS_DIR, "claves_sesion"))
+REVOCADAS = RevocacionesSesion(os.path.join(CUENTAS_DIR, "revocadas.sqlite3"))
+
+def firmar_token(user):
+    """Cookie firmada clave.usuario.expira.jti.firma (todo base64url o dígitos)."""
+    clave_id, clave = CLAVES_SESION.activa()
+    cuerpo = f"{clave_id}.{b64_codificar(user.encode())}.{int(time.time() + SESION_MAXIMA)}.{secrets.token_hex(8)}"
+    return cuerpo + "." + b64_codificar(hmac.new(clave, cuerpo.encode(), hashlib.sha256).digest())
+
+def leer_token(token):
+    """(usuario, expira, jti) si la firma es válida y no ha caducado; None si no."""
+    partes = token.split(".")
+    if len(partes) != 5:
+        return None
+    clave_id, usuario, expira, jti, firma = partes
+    clave = CLAVES_SESION.buscar(clave_id)
+    if clave is None:
+        return None
+    cuerpo = ".".join(partes[:4])
+    esperada = b64_codificar(hmac.new(clave, cuerpo.encode(), hashlib.sha256).digest())
+    if not hmac.compare_digest(esperada, firma) or not expira.isdigit() or int(expira) < time.time():
+        return None
+    try:
+        return b64_decodificar(usuario).decode("utf-8"), int(expira), jti
+    except ValueError:
+        return None
+
+def ruta_session(sid):
+    """Archivo de la sesión en SESSIONS_DIR (None si el sid no es hexadecimal)."""
+    if not sid or any(c not in "0123456789abcdef" for c in sid):
+        return None
+    return os.path.join(SESSIONS_DIR, sid)
+
 def crear_cookie_session(user):
+    if SESIONES_FIRMADAS:
+        return firmar_token(user)
     sid = secrets.token_hex(16)
-    SESSIONS[sid] = user
+    if SESIONES_COMPARTIDAS:
+        # Escritura atómica: otro worker nunca lee una sesión a medio escribir
+        tmp = ruta_session(sid) + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(f"{user}\n{time.time()}")
+        os.replace(tmp, ruta_session(sid))
+    else:
+        SESSIONS.crear(sid, user)
     return sid
 
+def buscar_session(sid):
+    if SESIONES_FIRMADAS:
+        datos = leer_token(sid)
+        if datos is None or REVOCADAS.contiene(datos[2]):
+            return None
+        return datos[0]
+    if not SESIONES_COMPARTIDAS:
+        return SESSIONS.buscar(sid)
+    ruta = ruta_session(sid)
+    if not ruta:
+        return None
+    # En disco el mtime es el último uso y la segunda línea la creación
+    try:
+        usada = os.stat(ruta).st_mtime
+        with open(ruta, "r", encoding="utf-8") as f:
+            user, _, creada = f.read().partition("\n")
+    except OSError:
+        return None
+    ahora = time.time()
+    try:
+        creada = float(creada)
+    except ValueError:
+        creada = usada
+    if ahora - usada > SESION_INACTIVA or ahora - creada > SESION_MAXIMA:
+        borrar_session(sid)
+        return None
+    if ahora - usada > SESION_LIMPIEZA:
+        # Se renueva el mtime como mucho una vez por pasada del limpiador, no en cada petición
+        try:
+            os.utime(ruta)
+        except OSError:
+            pass
+    return user or None
+
+def borrar_session(sid):
+    if SESIONES_FIRMADAS:
+        datos = leer_token(sid)
+        if datos is not None:
+            REVOCADAS.revocar(datos[2], datos[1])
+        return
+    if not SESIONES_COMPARTIDAS:
+        SESSIONS.borrar(sid)
+        return
+    ruta = ruta_session(sid)
+    if ruta:
+        try:
+            os.remove(ruta)
+        except OSError:
+            pass
+
+def limpiar_sesiones_disco():
+    """Borra las sesiones en disco sin usar desde hace SESION_INACTIVA y, si hay más de
+    MAX_SESIONES, las usadas hace más tiempo."""
+    ahora = time.time()
+    vivas = []
+    try:
+        with os.scandir(SESSIONS_DIR) as it:
+            for entrada in it:
+                try:
+                    usada = entrada.stat().st_mtime
+                except OSError:
+                    continue
+                if ahora - usada > SESION_INACTIVA:
+                    try:
+                        os.remove(entrada.path)
+                    except OSError:
+                        pass
+                elif not entrada.name.endswith(".tmp"):
+                    vivas.append((usada, entrada.path))
+    except OSError:
+        return
+    vivas.sort()
+    for _, ruta in vivas[:max(0, len(vivas) - MAX_SESIONES)]:
+        try:
+            os.remove(ruta)
+        except OSError:
+            pass
+
+def contar_sesiones():
+    if SESIONES_FIRMADAS:
+        return None  # no se guardan: solo se sabe cuántas se han revocado
+    if not SESIONES_COMPARTIDAS:
+        return len(SESSIONS)
+    try:
+        with os.scandir(SESSIONS_DIR) as it:
+            return sum(1 for entrada in it if not entrada.name.endswith(".tmp"))
+    except OSError:
+        return 0
+
+def limpiador_sesiones():
+    while True:
+        time.sleep(SESION_LIMPIEZA)
+        try:
+            if SESIONES_FIRMADAS:
+                REVOCADAS.limpiar()
+            elif SESIONES_COMPARTIDAS:
+                limpiar_sesiones_disco()
+            else:
+                SESSIONS.limpiar()
+        except Exception:
+            traceback.print_exc()
+
 def obtener_usuario_session(handler):
     cookie_header = handler.headers.get("Cookie", "")
     if not cookie_header: return None
     c = cookies.SimpleCookie()
     c.load(cookie_header)
     sid = c.get("sessionid")
-    if sid and sid.value in SESSIONS:
-        return SESSIONS[sid.value]
+    if sid:
+        return buscar_session(sid.value)
     return None
 
 def cerrar_session(handler):
@@ -53,8 +632,8 @@ def cerrar_session(handler):
     c = cookies.SimpleCookie()
     c.load(cookie_header)
     sid = c.get("sessionid")
-    if sid and sid.value in SESSIONS:
-        del SESSIONS[sid.value]
+    if sid:
+        borrar_session(sid.value)
 
 def safe_join(base, *paths):
     final_path = os.path.abspath(os.path.join(base, *paths))
@@ -71,26 +650,68 @@ def parent_folder(ruta_relativa):
 def es_html(nombre):
     return nombre.lower().endswith(".html")
 
+LISTADOS = ListadoCarpetas(LISTADOS_MAX)
+
+CATALOGO = CatalogoArchivos(os.path.join(CATALOGO_DIR, "ftp.sqlite3"))
+INDICE_PUBLICADOS = IndicePublicados(USERS_BASE, "", es_html, LISTADOS, CATALOGO)
+
 def listar_htdocs():
     """Devuelve un dict de usuario -> lista de archivos .html en su carpeta."""
-    resultado = {}
-    if not os.path.exists(USERS_BASE):
-        return resultado
-    for usuario in os.listdir(USERS_BASE):
-        user_dir = os.path.join(USERS_BASE, usuario)
-        if not os.path.isdir(user_dir):
-            continue
-        archivos = []
-        for root, dirs, files in os.walk(user_dir):
-            for f in files:
-                if es_html(f):
-                    ruta_rel = os.path.relpath(os.path.join(root, f), user_dir)
-                    archivos.append(ruta_rel.replace("\\", "/"))
-        if archivos:
-            resultado[usuario] = archivos
-    return resultado
-
-class FTPWebHandler(http.server.SimpleHTTPRequestHandler):
+    return INDICE_PUBLICADOS.listar()
+
+def pagina_servidores(prefijo, texto, pagina):
+    """Página de /servidores ya codificada: (cuerpo, etag)."""
+    htdocs, total = INDICE_PUBLICADOS.consultar(prefijo, texto, pagina)
+    paginas = max(1, -(-total // USUARIOS_POR_PAGINA))
+    filas = []
+    for user, archivos in htdocs:
+        filas.append(f"<h3>{user}</h3><ul>")
+        for f in archivos:
+            url = f"/servidores/{user}/{f}"
+            filas.append(f'<li><a href="{url}">{f}</a></li>')
+        filas.append("</ul>")
+    if not filas:
+        filas.append("<p>No hay archivos .html de usuarios aún.</p>" if not (prefijo or texto)
+                     else "<p>Ningún usuario ni archivo coincide con la búsqueda.</p>")
+    filtros = {k: v for k, v in (("prefijo", prefijo), ("q", texto)) if v}
+    navegacion = []
+    if pagina > 1:
+        navegacion.append(f'<a href="/servidores?{urlencode({**filtros, "pagina": pagina - 1})}">« Anterior</a>')
+    navegacion.append(f"Página {min(pagina, paginas)} de {paginas} ({total} usuarios)")
+    if pagina < paginas:
+        navegacion.append(f'<a href="/servidores?{urlencode({**filtros, "pagina": pagina + 1})}">Siguiente »</a>')
+    html = f"""
+<!DOCTYPE html>
+<html><head><title>Servidores web de usuarios</title><meta charset="utf-8"/></head>
+<body>
+<h2>Servidores web de usuarios</h2>
+<p>Aquí aparecen todos los archivos .html de cada usuario.<br/>
+Puedes enlazar directamente a <code>/servidores/usuario/archivo.html</code></p>
+<form method="get" action="/servidores">
+    Usuario empieza por: <input name="prefijo" value="{escape(prefijo)}"/>
+    Buscar: <input name="q" value="{escape(texto)}"/>
+    <button type="submit">Filtrar</button>
+</form>
+<p>{" | ".join(navegacion)}</p>
+{''.join(filas)}
+</body></html>
+"""
+    cuerpo = html.encode("utf-8")
+    etag = '"' + hashlib.sha1(cuerpo).hexdigest()[:20] + '"'
+    return cuerpo, etag
+
+CACHE_SERVIDORES = CacheRevalidada(CACHE_SERVIDORES_TTL, CONSULTAS_MAX,
+                                   lambda: INDICE_PUBLICADOS.instantanea()[0])
+
+COMPRIMIDOS = Comprimidos(WEB_ROOT, COMPRIMIDOS_DIR)
+
+CACHE_PAGINAS = CacheBytes(CACHE_MAX_BYTES, CACHE_MAX_ENTRADA)
+
+class FTPWebHandler(ManejadorBase):
+    cache_paginas = CACHE_PAGINAS
+    comprimidos = COMPRIMIDOS
+    catalogo = CATALOGO
+
     def translate_path(self, path):
         path = path.split('?',1)[0]
         path = path.split('#',1)[0]
@@ -99,18 +720,25 @@ class FTPWebHandler(http.server.SimpleHTTPRequestHandler):
 
     def do_GET(self):
         parsed = urlparse(self.path)
-        user = obtener_usuario_session(self)
         file_path = self.translate_path(parsed.path)
+        # translate_path no quita los '..': nada fuera de WEB_ROOT (tampoco por enlaces)
+        if not dentro_de(file_path, WEB_ROOT):
+            self.send_error(403, "Acceso prohibido")
+            return
         # Bloquear acceso a usuarios.txt y otros archivos de control
         if os.path.abspath(file_path) == os.path.abspath(USERS_FILE):
             self.send_error(403, "Acceso prohibido")
             return
+        if os.path.abspath(file_path).startswith((SESSIONS_DIR + os.sep, COMPRIMIDOS_DIR + os.sep,
+                                                  CATALOGO_DIR + os.sep, CUENTAS_DIR + os.sep)):
+            self.send_error(403, "Acceso prohibido")
+            return
 
         if parsed.path == "/":
             self.redirect("/servidores")
             return
         if parsed.path == "/servidores":
-            self.serve_servidores()
+            self.serve_servidores(parse_qs(parsed.query))
             return
         if parsed.path.startswith("/servidores/"):
             partes = parsed.path.strip("/").split("/", 2)
@@ -123,17 +751,16 @@ class FTPWebHandler(http.server.SimpleHTTPRequestHandler):
                 except Exception:
                     self.send_error(403, "Acceso denegado")
                     return
-                if os.path.isfile(ruta) and es_html(ruta):
-                    with open(ruta, "r", encoding="utf-8") as f:
-                        contenido = f.read()
-                    self.send_response(200)
-                    self.send_header("Content-Type", "text/html; charset=utf-8")
-                    self.end_headers()
-                    self.wfile.write(contenido.encode("utf-8"))
+                # Un archivo que el catálogo conoce al día existe: no hace falta preguntárselo al disco
+                if es_html(ruta) and (CATALOGO.metadatos(ruta) is not None or os.path.isfile(ruta)):
+                    self.enviar_archivo(ruta, "text/html; charset=utf-8")
                     return
                 else:
                     self.send_error(404, "Archivo no encontrado o no es HTML")
                     return
+        if parsed.path == "/estado":
+            self.serve_estado()
+            return
         if parsed.path == "/login":
             self.serve_login()
             return
@@ -142,12 +769,14 @@ class FTPWebHandler(http.server.SimpleHTTPRequestHandler):
             self.send_response(302)
             self.send_header("Set-Cookie", "sessionid=; Path=/; Max-Age=0")
             self.send_header("Location", "/login")
+            self.send_header("Content-Length", "0")
             self.end_headers()
             return
         if parsed.path == "/nuevo_usuario":
             self.serve_nuevo_usuario()
             return
         if parsed.path == "/editor":
+            user = obtener_usuario_session(self)
             if not user:
                 self.redirect("/login")
                 return
@@ -158,7 +787,8 @@ class FTPWebHandler(http.server.SimpleHTTPRequestHandler):
             return
         # Bloqueo de otros archivos de control aquí si quieres
         if os.path.isfile(file_path):
-            super().do_GET()
+            # Estáticos (css, imágenes...): validadores, compresión y sendfile
+            self.enviar_archivo(file_path, self.guess_type(file_path))
             return
         self.send_error(404, "No encontrado")
 
@@ -166,42 +796,46 @@ class FTPWebHandler(http.server.SimpleHTTPRequestHandler):
         parsed = urlparse(self.path)
         user = obtener_usuario_session(self)
         if parsed.path == "/login":
-            content_length = int(self.headers.get('Content-Length', 0))
-            post_data = self.rfile.read(content_length).decode('utf-8')
-            params = parse_qs(post_data)
-            usuarios = cargar_usuarios()
+            params = self.leer_formulario()
             username = params.get("usuario", [""])[0].strip()
             password = params.get("password", [""])[0]
             mensaje = ""
             if not username or not password:
                 mensaje = "Usuario y contraseña requeridos."
-            elif username not in usuarios or usuarios[username] != hash_password(password):
-                mensaje = "Usuario o contraseña incorrectos."
             else:
+                try:
+                    correcta = comprobar_usuario(username, password)
+                except HashOcupado as e:
+                    self.enviar_ocupado(str(e))
+                    return
+                if not correcta:
+                    mensaje = "Usuario o contraseña incorrectos."
+            if not mensaje:
                 sid = crear_cookie_session(username)
                 self.send_response(302)
                 self.send_header("Set-Cookie", f"sessionid={sid}; Path=/")
                 self.send_header("Location", "/editor")
+                self.send_header("Content-Length", "0")
                 self.end_headers()
                 return
             self.serve_login(mensaje)
             return
         if parsed.path == "/nuevo_usuario":
-            content_length = int(self.headers.get('Content-Length', 0))
-            post_data = self.rfile.read(content_length).decode('utf-8')
-            params = parse_qs(post_data)
-            usuarios = cargar_usuarios()
+            params = self.leer_formulario()
             username = params.get("usuario", [""])[0].strip()
             password = params.get("password", [""])[0]
             mensaje = ""
             if not username or not password:
                 mensaje = "Usuario y contraseña requeridos."
-            elif username in usuarios:
-                mensaje = "Ese usuario ya existe."
-            elif ':' in username:
-                mensaje = "El usuario no puede contener dos puntos."
             else:
-                guardar_usuario(username, password)
+                try:
+                    creado = guardar_usuario(username, password)
+                except HashOcupado as e:
+                    self.enviar_ocupado(str(e))
+                    return
+                if not creado:
+                    mensaje = "Ese usuario ya existe."
+            if not mensaje:
                 crear_carpeta_usuario(username)
                 mensaje = "Usuario creado. Ahora inicia sesión."
                 self.serve_login(mensaje)
@@ -209,12 +843,11 @@ class FTPWebHandler(http.server.SimpleHTTPRequestHandler):
             self.serve_nuevo_usuario(mensaje)
             return
         if parsed.path == "/editor":
+            # Se lee el cuerpo siempre: en conexiones persistentes no puede quedar a medias
+            params = self.leer_formulario()
             if not user:
                 self.redirect("/login")
                 return
-            content_length = int(self.headers.get('Content-Length', 0))
-            post_data = self.rfile.read(content_length).decode('utf-8')
-            params = parse_qs(post_data)
             action = params.get("accion", [""])[0]
             archivo = params.get("archivo", [""])[0]
             carpeta_rel = params.get("carpeta_rel", [""])[0]
@@ -233,10 +866,14 @@ class FTPWebHandler(http.server.SimpleHTTPRequestHandler):
                     contenido = params.get("contenido", [""])[0]
                     with open(ruta, "w", encoding="utf-8") as f:
                         f.write(contenido)
+                    COMPRIMIDOS.precomprimir(ruta)
+                    INDICE_PUBLICADOS.refrescar(os.path.dirname(ruta))
                     mensaje = f"Archivo '{archivo}' guardado."
                 elif action == "borrar" and archivo:
                     ruta = safe_join(ruta_base, archivo)
                     os.remove(ruta)
+                    COMPRIMIDOS.borrar(ruta)
+                    INDICE_PUBLICADOS.refrescar(os.path.dirname(ruta))
                     archivo = ""
                     mensaje = f"Archivo borrado."
                 elif action == "crear_carpeta":
@@ -244,6 +881,7 @@ class FTPWebHandler(http.server.SimpleHTTPRequestHandler):
                     if carpeta:
                         ruta_carpeta = safe_join(ruta_base, carpeta)
                         os.makedirs(ruta_carpeta, exist_ok=True)
+                        INDICE_PUBLICADOS.refrescar(ruta_carpeta)
                         mensaje = f"Carpeta '{carpeta}' creada."
                     else:
                         mensaje = "Debes indicar el nombre de la carpeta a crear."
@@ -259,32 +897,27 @@ class FTPWebHandler(http.server.SimpleHTTPRequestHandler):
             return
         self.send_error(404, "No encontrado")
 
-    def serve_servidores(self):
-        """Página pública con enlaces a todos los .html de todos los usuarios."""
-        htdocs = listar_htdocs()
-        filas = []
-        for user, archivos in sorted(htdocs.items()):
-            filas.append(f"<h3>{user}</h3><ul>")
-            for f in sorted(archivos):
-                url = f"/servidores/{user}/{f}"
-                filas.append(f'<li><a href="{url}">{f}</a></li>')
-            filas.append("</ul>")
-        if not filas:
-            filas.append("<p>No hay archivos .html de usuarios aún.</p>")
-        html = f"""
-<!DOCTYPE html>
-<html><head><title>Servidores web de usuarios</title><meta charset="utf-8"/></head>
-<body>
-<h2>Servidores web de usuarios</h2>
-<p>Aquí aparecen todos los archivos .html de cada usuario.<br/>
-Puedes enlazar directamente a <code>/servidores/usuario/archivo.html</code></p>
-{''.join(filas)}
-</body></html>
-"""
-        self.send_response(200)
-        self.send_header("Content-Type", "text/html; charset=utf-8")
-        self.end_headers()
-        self.wfile.write(html.encode("utf-8"))
+    def serve_servidores(self, params):
+        """Página pública con enlaces a los .html de los usuarios, paginada por usuario.
+
+        ?prefijo= filtra por inicio del nombre de usuario, ?q= busca en nombres
+        de usuario y de archivo y ?pagina= elige la página. La página sale de
+        CACHE_SERVIDORES y lleva ETag del contenido (304 si no ha cambiado).
+        """
+        prefijo = params.get("prefijo", [""])[0].strip()
+        texto = params.get("q", [""])[0].strip()
+        try:
+            pagina = max(1, int(params.get("pagina", ["1"])[0]))
+        except ValueError:
+            pagina = 1
+        cuerpo, etag = CACHE_SERVIDORES.obtener((prefijo, texto, pagina),
+                                                lambda: pagina_servidores(prefijo, texto, pagina))
+        if self.etag_coincide(etag):
+            self.enviar_cabeceras(304, {"ETag": etag, "Cache-Control": "no-cache"})
+            return
+        self.enviar_cabeceras(200, {"Content-Type": "text/html; charset=utf-8", "Content-Length": str(len(cuerpo)),
+                                    "ETag": etag, "Cache-Control": "no-cache"})
+        self.wfile.write(cuerpo)
 
     def serve_login(self, mensaje=""):
         html = f"""
@@ -301,10 +934,7 @@ Puedes enlazar directamente a <code>/servidores/usuario/archivo.html</code></p>
 <p>¿No tienes cuenta? <a href="/nuevo_usuario">Regístrate</a></p>
 </body></html>
 """
-        self.send_response(200)
-        self.send_header("Content-Type", "text/html; charset=utf-8")
-        self.end_headers()
-        self.wfile.write(html.encode("utf-8"))
+        self.enviar_html(html)
 
     def serve_nuevo_usuario(self, mensaje=""):
         html = f"""
@@ -321,17 +951,19 @@ Puedes enlazar directamente a <code>/servidores/usuario/archivo.html</code></p>
 <p><a href="/login">Volver a login</a></p>
 </body></html>
 """
-        self.send_response(200)
-        self.send_header("Content-Type", "text/html; charset=utf-8")
-        self.end_headers()
-        self.wfile.write(html.encode("utf-8"))
+        self.enviar_html(html)
 
     def serve_editor(self, user, carpeta_rel="", archivo="", contenido="", mensaje=""):
         user_dir = crear_carpeta_usuario(user)
         ruta_base = safe_join(user_dir, carpeta_rel)
-        entradas = os.listdir(ruta_base) if os.path.exists(ruta_base) else []
-        archivos = [f for f in entradas if os.path.isfile(os.path.join(ruta_base, f))]
-        carpetas = [d for d in entradas if os.path.isdir(os.path.join(ruta_base, d))]
+        try:
+            _, carpetas, archivos = LISTADOS.listar(ruta_base)
+        except OSError:
+            carpetas, archivos = (), ()
+        # Tamaños del catálogo, sin un stat por archivo, si tiene los mismos archivos que la carpeta
+        catalogados = CATALOGO.archivos(ruta_base)
+        if catalogados is not None and tuple(fila[0] for fila in catalogados) == archivos:
+            archivos = [f"{nombre} ({tamano} bytes)" for nombre, tamano, _, _ in catalogados]
         archivos_listado = "<br>".join(archivos) if archivos else "No hay archivos aún."
         carpetas_listado = ""
         for carpeta in carpetas:
@@ -391,20 +1023,249 @@ Ruta actual: /{carpeta_rel}
 <p><b>Archivos en esta carpeta:</b><br>{archivos_listado}</p>
 </body></html>
 """
-        self.send_response(200)
-        self.send_header("Content-Type", "text/html; charset=utf-8")
-        self.end_headers()
-        self.wfile.write(html.encode("utf-8"))
+        self.enviar_html(html)
+
+    def leer_formulario(self):
+        content_length = int(self.headers.get('Content-Length', 0))
+        post_data = self.rfile.read(content_length).decode('utf-8')
+        return parse_qs(post_data)
+
+    def serve_estado(self):
+        """Contadores internos en JSON (aciertos/fallos de las cachés...); solo desde esta máquina."""
+        if not self.cliente_local():
+            self.send_error(403, "El estado solo se consulta desde el propio servidor")
+            return
+        cuerpo = json.dumps({"sesiones": {"activas": contar_sesiones()},
+                             "cache_paginas": CACHE_PAGINAS.estadisticas(),
+                             "cache_servidores": CACHE_SERVIDORES.estadisticas(),
+                             "listados": LISTADOS.estadisticas()}).encode("utf-8")
+        self.enviar_cabeceras(200, {"Content-Type": "application/json",
+                                    "Content-Length": str(len(cuerpo)),
+                                    "Cache-Control": "no-store"})
+        self.wfile.write(cuerpo)
 
     def redirect(self, path):
         self.send_response(302)
         self.send_header("Location", path)
+        self.send_header("Content-Length", "0")
         self.end_headers()
 
+class _SalidaAsync(io.RawIOBase):
+    """wfile del manejador en el motor async: guarda la respuesta para que la envíe el bucle.
+
+    Los bytes escritos se juntan en memoria; los archivos grandes no se
+    copian: copiar_archivo los deja apuntados (con un descriptor propio) y
+    el bucle los manda después con loop.sendfile.
+    """
+    def __init__(self):
+        self.partes = []   # bytes o (archivo, inicio, longitud), en orden de envío
+
+    def writable(self):
+        return True
+
+    def write(self, datos):
+        self.partes.append(bytes(datos))
+        return len(datos)
+
+    def adjuntar(self, f, inicio, longitud):
+        self.partes.append((os.fdopen(os.dup(f.fileno()), "rb"), inicio, longitud))
+
+    def close(self):
+        for parte in self.partes:
+            if not isinstance(parte, bytes):
+                parte[0].close()
+        self.partes = []
+        super().close()
+
+async def leer_peticion(reader):
+    """Lee línea de petición, cabeceras y cuerpo (Content-Length). b"" si se cerró."""
+    try:
+        cabecera = await reader.readuntil(b"\r\n\r\n")
+    except asyncio.IncompleteReadError:
+        return b""
+    longitud = 0
+    for linea in cabecera.split(b"\r\n")[1:]:
+        nombre, _, valor = linea.partition(b":")
+        if nombre.strip().lower() == b"content-length":
+            longitud = int(valor.strip() or 0)
+    cuerpo = await reader.readexactly(longitud) if longitud > 0 else b""
+    return cabecera + cuerpo
+
+def en_bucle(datos):
+    """True si la petición es de las que no tocan disco y se contestan en el propio bucle."""
+    metodo, _, resto = datos.partition(b" ")
+    ruta = resto.split(b" ", 1)[0].split(b"?", 1)[0]
+    return metodo == b"GET" and ruta in RUTAS_BUCLE
+
+class ServidorAsync:
+    """Motor asyncio: un solo bucle de eventos atiende todas las conexiones.
+
+    Las rutas las sigue resolviendo el manejador (p. ej. FTPWebHandler). Las
+    que solo generan HTML (RUTAS_BUCLE) se ejecutan en el bucle; el resto,
+    que lee o escribe archivos, en un pool de hilos acotado. En ambos casos
+    el manejador solo prepara la respuesta: la envía el bucle por el
+    transporte (drain o loop.sendfile), con TIEMPO_INACTIVO de plazo para
+    cada bloque; si el cliente no lee en ese tiempo se corta la conexión,
+    así un cliente lento nunca retiene un hilo.
+    """
+    def __init__(self, direccion, manejador, hilos=MAX_HILOS_IO, sock=None):
+        self.direccion = direccion
+        self.manejador = manejador
+        self.sock = sock
+        self.ejecutor = ThreadPoolExecutor(max_workers=hilos, thread_name_prefix="io")
+
+    def procesar(self, datos, cliente, atendidas):
+        """(salida con la respuesta, cerrar conexión)."""
+        salida = _SalidaAsync()
+        handler = self.manejador.__new__(self.manejador)
+        handler.peticiones = atendidas
+        handler.request = None
+        handler.server = self
+        handler.client_address = cliente
+        handler.directory = WEB_ROOT
+        handler.rfile = io.BytesIO(datos)
+        handler.wfile = salida
+        handler.close_connection = True
+        try:
+            handler.handle_one_request()
+        except BaseException:
+            salida.close()
+            raise
+        return salida, handler.close_connection
+
+    async def enviar(self, writer, salida):
+        loop = asyncio.get_running_loop()
+        try:
+            for parte in salida.partes:
+                if isinstance(parte, bytes):
+                    writer.write(parte)
+                    continue
+                await asyncio.wait_for(writer.drain(), TIEMPO_INACTIVO)
+                f, inicio, longitud = parte
+                fin = inicio + longitud
+                while inicio < fin:
+                    n = min(BLOQUE_ASYNC, fin - inicio)
+                    enviados = await asyncio.wait_for(
+                        loop.sendfile(writer.transport, f, inicio, n), TIEMPO_INACTIVO)
+                    if not enviados:
+                        break
+                    inicio += enviados
+            await asyncio.wait_for(writer.drain(), TIEMPO_INACTIVO)
+        finally:
+            salida.close()
+
+    async def atender(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        cliente = writer.get_extra_info("peername") or ("", 0)
+        atendidas = 0
+        try:
+            # Las peticiones encadenadas (pipelining) ya quedan en el buffer del
+            # reader y se contestan en orden, una tras otra.
+            while atendidas < MAX_PETICIONES_CONEXION:
+                datos = await asyncio.wait_for(leer_peticion(reader), TIEMPO_INACTIVO)
+                if not datos:
+                    break
+                if en_bucle(datos):
+                    salida, cerrar = self.procesar(datos, cliente[:2], atendidas)
+                else:
+                    salida, cerrar = await loop.run_in_executor(self.ejecutor, self.procesar,
+                                                                datos, cliente[:2], atendidas)
+                await self.enviar(writer, salida)
+                atendidas += 1
+                if cerrar:
+                    break
+        except asyncio.TimeoutError:
+            # No envía ni lee: se corta sin esperar a que se vacíe lo pendiente
+            writer.transport.abort()
+        except (ConnectionError, asyncio.LimitOverrunError, ValueError):
+            pass
+        finally:
+            writer.close()
+            try:
+                await asyncio.wait_for(writer.wait_closed(), TIEMPO_INACTIVO)
+            except asyncio.TimeoutError:
+                writer.transport.abort()
+            except ConnectionError:
+                pass
+
+    async def principal(self):
+        if self.sock is not None:
+            servidor = await asyncio.start_server(self.atender, sock=self.sock, limit=MAX_CABECERAS)
+        else:
+            host, port = self.direccion
+            servidor = await asyncio.start_server(self.atender, host or None, port, limit=MAX_CABECERAS)
+        async with servidor:
+            await servidor.serve_forever()
+
+    def serve_forever(self):
+        try:
+            asyncio.run(self.principal())
+        finally:
+            self.ejecutor.shutdown(wait=False)
+
+def crear_servidor(direccion, args, sock=None):
+    """Crea el servidor del motor elegido; si se da sock, escucha en ese socket ya abierto."""
+    global POOL_HASH
+    if args.hash_procesos > 0 and hasattr(os, "fork"):
+        # Se crea antes de lanzar hilos: los procesos del pool se hacen con fork
+        POOL_HASH = PoolHash(args.hash_procesos)
+        POOL_HASH.arrancar()
+    threading.Thread(target=limpiador_sesiones, daemon=True).start()
+    # El índice de /servidores se construye ya, en segundo plano, no en la primera petición
+    threading.Thread(target=INDICE_PUBLICADOS.iniciar, daemon=True).start()
+    if args.motor == "async":
+        return ServidorAsync(direccion, FTPWebHandler, hilos=args.hilos_io, sock=sock)
+    if args.motor == "pool":
+        httpd = ServidorPoolHilos(direccion, FTPWebHandler, hilos=args.hilos, cola=args.cola,
+                                  pila_kb=args.pila_kb, bind_and_activate=sock is None)
+    else:
+        httpd = socketserver.ThreadingTCPServer(direccion, FTPWebHandler, bind_and_activate=sock is None)
+    if sock is not None:
+        httpd.socket.close()
+        httpd.socket = sock
+    return httpd
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Servidor FTP Web")
+    parser.add_argument("--motor", choices=("hilos", "pool", "async"), default="hilos",
+                        help="hilos: un hilo por conexión; pool: hilos fijos y cola acotada; "
+                             "async: un bucle de eventos")
+    parser.add_argument("--hilos", type=int, default=HILOS_POOL,
+                        help="motor pool: número fijo de hilos")
+    parser.add_argument("--cola", type=int, default=COLA_POOL,
+                        help="motor pool: conexiones en espera antes de responder 503")
+    parser.add_argument("--pila-kb", type=int, default=PILA_HILO_KB,
+                        help="motor pool: tamaño de pila de cada hilo en KiB")
+    parser.add_argument("--hilos-io", type=int, default=MAX_HILOS_IO,
+                        help="tamaño del pool de E/S del motor async")
+    parser.add_argument("--procesos", type=int, default=1,
+                        help="workers pre-fork (más de 1 usa varios núcleos)")
+    parser.add_argument("--reuseport", action="store_true",
+                        help="en pre-fork, un socket SO_REUSEPORT por worker")
+    parser.add_argument("--sesiones-firmadas", action="store_true",
+                        help="cookies de sesión firmadas con HMAC, sin estado en el servidor")
+    parser.add_argument("--rotar-clave-sesion", action="store_true",
+                        help="añade una clave nueva para firmar sesiones y termina")
+    parser.add_argument("--hash-procesos", type=int, default=HASH_PROCESOS,
+                        help="procesos para el hash de contraseñas (0 = en el hilo de la petición)")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    if args.rotar_clave_sesion:
+        CLAVES_SESION.rotar()
+        print(f"Nueva clave de sesión activa en {CLAVES_SESION.ruta}")
+        sys.exit(0)
+    if args.sesiones_firmadas:
+        SESIONES_FIRMADAS = True
+        CLAVES_SESION.activa()  # crea el archivo de claves antes de lanzar workers
     PORT = 8080
-    print(f"Servidor FTP Web SOLO HTML corriendo en http://localhost:{PORT}/")
+    print(f"Servidor FTP Web SOLO HTML corriendo en http://localhost:{PORT}/ (motor {args.motor})")
     print("Cada usuario SOLO puede crear, leer y borrar archivos.")
     print("Todos los archivos .html públicos en /servidores")
-    with socketserver.ThreadingTCPServer(("", PORT), FTPWebHandler) as httpd:
-        httpd.serve_forever()
\ No newline at end of file
+    if args.procesos > 1 and hasattr(os, "fork"):
+        # Las sesiones van a SESSIONS_DIR para que las vean todos los workers
+        SESIONES_COMPARTIDAS = True
+        os.makedirs(SESSIONS_DIR, exist_ok=True)
+        prefork(("", PORT), args.procesos, args.reuseport,
+                lambda sock: crear_servidor(("", PORT), args, sock))
+    else:
+        crear_servidor(("", PORT), args).serve_forever()
\ No newline at end of file
@@ -1,7 +1,11 @@
 import http.server
 import socketserver
-from urllib.parse import urlparse, parse_qs, unquote
-import os, hashlib, secrets
+from urllib.parse import urlparse, parse_qs, unquote, urlencode
+from html import escape
+import os, hashlib, secrets, re, posixpath
+import json
+import time, threading, argparse, sys, itertools
+from concurrent.futures import ProcessPoolExecutor
 from http import cookies
 
 try:
@@ -9,11 +13,33 @@ try:
 except ImportError:
     Template = None
 
+from comun import (ManejadorBase, ServidorPoolHilos, prefork, HILOS_POOL, COLA_POOL, PILA_HILO_KB,
+                   Comprimidos, CacheBytes, ListadoCarpetas, CatalogoArchivos, IndicePublicados,
+                   CacheRevalidada, USUARIOS_POR_PAGINA, CONSULTAS_MAX,
+                   CacheTemplates, LookupSitio, ruta_uri,
+                   ruta_modulo, limpiar_modulos_viejos, PoolRender, RenderTimeout, RenderOcupado,
+                   RENDER_TIEMPO_MAX, RENDER_CPU_MAX, RENDER_MEMORIA_MB)
+
 WEB_ROOT = os.path.abspath(os.path.dirname(__file__))
 USERS_FILE = os.path.join(WEB_ROOT, "usuarios.txt")
 USERS_BASE = os.path.join(WEB_ROOT, "usuarios")
 os.makedirs(USERS_BASE, exist_ok=True)
 SESSIONS = {}
+# En modo pre-fork las sesiones se guardan en disco para que las vean todos los workers
+SESSIONS_DIR = os.path.join(WEB_ROOT, "sesiones")
+SESIONES_COMPARTIDAS = False
+# Variantes comprimidas (gzip/brotli) de los archivos publicados, con el mtime del original
+COMPRIMIDOS_DIR = os.path.join(WEB_ROOT, "comprimidos")
+CATALOGO_DIR = os.path.join(WEB_ROOT, "catalogo")  # catálogo SQLite de archivos de usuarios
+CACHE_MAX_BYTES = 64 * 1024 * 1024   # memoria total para páginas publicadas en caché
+CACHE_MAX_ENTRADA = 1024 * 1024      # las respuestas más grandes se envían desde disco
+MAX_TEMPLATES = 512                  # templates .mako compilados que se mantienen en memoria
+MODULOS_DIR = os.path.join(WEB_ROOT, "mako_modulos")  # módulos compilados, compartidos entre procesos
+CACHE_SALIDA_TTL = 0                 # segundos que se reutiliza la salida de un .mako (0 = nunca)
+MARCA_SIN_CACHE = "## sin-cache"     # comentario Mako que excluye una página de esa caché...
+LINEAS_MARCA = 5                     # ...si ocupa una línea propia entre las primeras LINEAS_MARCA
+CACHE_SERVIDORES_TTL = 30    # /servidores: segundos que una página generada se sirve sin rehacerla
+LISTADOS_MAX = 1024          # carpetas cuyo listado se guarda en memoria
 
 def hash_password(pwd):
     return hashlib.sha256(pwd.encode()).hexdigest()
@@ -40,19 +66,55 @@ def crear_carpeta_usuario(username):
     os.makedirs(htdocs_dir, exist_ok=True)
     return user_dir
 
+def ruta_session(sid):
+    """Archivo de la sesión en SESSIONS_DIR (None si el sid no es hexadecimal)."""
+    if not sid or any(c not in "0123456789abcdef" for c in sid):
+        return None
+    return os.path.join(SESSIONS_DIR, sid)
+
 def crear_cookie_session(user):
     sid = secrets.token_hex(16)
-    SESSIONS[sid] = user
+    if SESIONES_COMPARTIDAS:
+        # Escritura atómica: otro worker nunca lee una sesión a medio escribir
+        tmp = ruta_session(sid) + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(user)
+        os.replace(tmp, ruta_session(sid))
+    else:
+        SESSIONS[sid] = user
     return sid
 
+def buscar_session(sid):
+    if not SESIONES_COMPARTIDAS:
+        return SESSIONS.get(sid)
+    ruta = ruta_session(sid)
+    if not ruta:
+        return None
+    try:
+        with open(ruta, "r", encoding="utf-8") as f:
+            return f.read() or None
+    except OSError:
+        return None
+
+def borrar_session(sid):
+    if not SESIONES_COMPARTIDAS:
+        SESSIONS.pop(sid, None)
+        return
+    ruta = ruta_session(sid)
+    if ruta:
+        try:
+            os.remove(ruta)
+        except OSError:
+            pass
+
 def obtener_usuario_session(handler):
     cookie_header = handler.headers.get("Cookie", "")
     if not cookie_header: return None
     c = cookies.SimpleCookie()
     c.load(cookie_header)
     sid = c.get("sessionid")
-    if sid and sid.value in SESSIONS:
-        return SESSIONS[sid.value]
+    if sid:
+        return buscar_session(sid.value)
     return None
 
 def cerrar_session(handler):
@@ -60,8 +122,8 @@ def cerrar_session(handler):
     c = cookies.SimpleCookie()
     c.load(cookie_header)
     sid = c.get("sessionid")
-    if sid and sid.value in SESSIONS:
-        del SESSIONS[sid.value]
+    if sid:
+        borrar_session(sid.value)
 
 def safe_join(base, *paths):
     final_path = os.path.abspath(os.path.join(base, *paths))
@@ -72,23 +134,62 @@ def safe_join(base, *paths):
 def es_htmlo_mako(fname):
     return fname.endswith(".html") or fname.endswith(".mako")
 
+LISTADOS = ListadoCarpetas(LISTADOS_MAX)
+
+CATALOGO = CatalogoArchivos(os.path.join(CATALOGO_DIR, "puro.sqlite3"))
+INDICE_PUBLICADOS = IndicePublicados(USERS_BASE, "htdocs", es_htmlo_mako, LISTADOS, CATALOGO)
+
 def listar_htdocs():
     """Devuelve un dict de usuario -> lista de archivos en htdocs."""
-    resultado = {}
-    if not os.path.exists(USERS_BASE):
-        return resultado
-    for usuario in os.listdir(USERS_BASE):
-        htdocs = os.path.join(USERS_BASE, usuario, "htdocs")
-        if os.path.exists(htdocs) and os.path.isdir(htdocs):
-            archivos = []
-            for root, dirs, files in os.walk(htdocs):
-                for f in files:
-                    if f.endswith(".html") or f.endswith(".mako"):
-                        ruta_rel = os.path.relpath(os.path.join(root, f), htdocs)
-                        archivos.append(ruta_rel.replace("\\", "/"))
-            if archivos:
-                resultado[usuario] = archivos
-    return resultado
+    return INDICE_PUBLICADOS.listar()
+
+def pagina_servidores(prefijo, texto, pagina):
+    """Página de /servidores ya codificada: (cuerpo, etag)."""
+    htdocs, total = INDICE_PUBLICADOS.consultar(prefijo, texto, pagina)
+    paginas = max(1, -(-total // USUARIOS_POR_PAGINA))
+    filas = []
+    for user, archivos in htdocs:
+        filas.append(f"<h3>{user}</h3><ul>")
+        idx = next((n for n in ("index.html", "index.mako") if n in archivos), None)
+        if idx:
+            filas.append(f'<li><a href="/web/{user}/">{user}/htdocs/ (index)</a></li>')
+        for f in archivos:
+            if f == idx:
+                continue
+            filas.append(f'<li><a href="/web/{user}/{f}">{f}</a></li>')
+        filas.append("</ul>")
+    if not filas:
+        filas.append("<p>No hay webs de usuarios aún.</p>" if not (prefijo or texto)
+                     else "<p>Ningún usuario ni archivo coincide con la búsqueda.</p>")
+    filtros = {k: v for k, v in (("prefijo", prefijo), ("q", texto)) if v}
+    navegacion = []
+    if pagina > 1:
+        navegacion.append(f'<a href="/servidores?{urlencode({**filtros, "pagina": pagina - 1})}">« Anterior</a>')
+    navegacion.append(f"Página {min(pagina, paginas)} de {paginas} ({total} usuarios)")
+    if pagina < paginas:
+        navegacion.append(f'<a href="/servidores?{urlencode({**filtros, "pagina": pagina + 1})}">Siguiente »</a>')
+    html = f"""
+<!DOCTYPE html>
+<html><head><title>Servidores web de usuarios</title><meta charset="utf-8"/></head>
+<body>
+<h2>Servidores web de usuarios</h2>
+<p>Aquí aparecen todos los archivos .html y .mako en htdocs de cada usuario.<br/>
+Puedes enlazar directamente a <code>/web/usuario/archivo</code> o a <code>/web/usuario/</code> para el index.</p>
+<form method="get" action="/servidores">
+    Usuario empieza por: <input name="prefijo" value="{escape(prefijo)}"/>
+    Buscar: <input name="q" value="{escape(texto)}"/>
+    <button type="submit">Filtrar</button>
+</form>
+<p>{" | ".join(navegacion)}</p>
+{''.join(filas)}
+</body></html>
+"""
+    cuerpo = html.encode("utf-8")
+    etag = '"' + hashlib.sha1(cuerpo).hexdigest()[:20] + '"'
+    return cuerpo, etag
+
+CACHE_SERVIDORES = CacheRevalidada(CACHE_SERVIDORES_TTL, CONSULTAS_MAX,
+                                   lambda: INDICE_PUBLICADOS.instantanea()[0])
 
 def encontrar_index(usuario, subruta=""):
     """Busca index.html o index.mako en la subruta de htdocs del usuario."""
@@ -100,7 +201,216 @@ def encontrar_index(usuario, subruta=""):
             return nombre
     return None
 
-class FTPWebHandler(http.server.SimpleHTTPRequestHandler):
+COMPRIMIDOS = Comprimidos(WEB_ROOT, COMPRIMIDOS_DIR)
+
+CACHE_PAGINAS = CacheBytes(CACHE_MAX_BYTES, CACHE_MAX_ENTRADA)
+# Salida ya renderizada de los .mako (solo con --cache-salida)
+CACHE_SALIDA = CacheBytes(CACHE_MAX_BYTES, CACHE_MAX_ENTRADA)
+
+def raiz_sitio(ruta):
+    """htdocs del usuario al que pertenece ruta, o None si está fuera de USERS_BASE/*/htdocs."""
+    partes = os.path.relpath(ruta, USERS_BASE).split(os.sep)
+    if len(partes) < 3 or partes[0] == ".." or partes[1] != "htdocs":
+        return None
+    return os.path.join(USERS_BASE, partes[0], "htdocs")
+
+def uri_sitio(ruta, raiz):
+    """URI de Mako de ruta dentro de su sitio: '/' es el htdocs del usuario."""
+    return "/" + os.path.relpath(ruta, raiz).replace(os.sep, "/")
+
+LOOKUPS = {}                # htdocs -> LookupSitio
+LOOKUPS_LOCK = threading.Lock()
+
+def lookup_sitio(raiz):
+    with LOOKUPS_LOCK:
+        lookup = LOOKUPS.get(raiz)
+        if lookup is None:
+            lookup = LOOKUPS[raiz] = LookupSitio(raiz, CACHE_TEMPLATES)
+        return lookup
+
+def compilar_template(ruta, st):
+    """Compila el .mako reutilizando, si existe, su módulo ya generado en MODULOS_DIR."""
+    modulo = ruta_modulo(MODULOS_DIR, ruta, st)
+    if not os.path.exists(modulo):
+        limpiar_modulos_viejos(modulo)
+    raiz = raiz_sitio(ruta)
+    if raiz is None:
+        return Template(filename=ruta, module_filename=modulo)
+    return Template(filename=ruta, uri=uri_sitio(ruta, raiz), lookup=lookup_sitio(raiz),
+                    module_filename=modulo)
+
+CACHE_TEMPLATES = CacheTemplates(MAX_TEMPLATES, compilar_template)
+
+PATRON_DEPENDENCIA = re.compile(
+    r"""<%\s*(?:inherit|include|namespace)\b[^>]*?\bfile\s*=\s*["']([^"'$]+)["']""")
+
+class DependenciasTemplates:
+    """Grafo de herencia e inclusión entre los .mako de cada sitio.
+
+    Se saca del texto de cada template (sin compilarlo, así vale también
+    cuando se renderiza en el pool) y se vuelve a leer solo si ese archivo
+    cambia. firma_completa cambia en cuanto cambia la página o cualquier
+    layout o include del que dependa, directa o indirectamente. De la misma
+    lectura sale si la página admite la caché de salida (MARCA_SIN_CACHE).
+    """
+    def __init__(self):
+        self.directas = {}  # ruta -> (firma, [rutas de las que depende], admite caché de salida)
+        self.lock = threading.Lock()
+
+    def analizar(self, ruta, firma):
+        """(dependencias directas, admite caché de salida) de esta versión de ruta."""
+        with self.lock:
+            entrada = self.directas.get(ruta)
+        if entrada is not None and entrada[0] == firma:
+            return entrada[1], entrada[2]
+        with open(ruta, encoding="utf-8", errors="replace") as f:
+            fuente = f.read()
+        deps = []
+        raiz = raiz_sitio(ruta)
+        if raiz is not None:
+            uri = uri_sitio(ruta, raiz)
+            for dep in PATRON_DEPENDENCIA.findall(fuente):
+                if not dep.startswith("/"):
+                    dep = posixpath.join(posixpath.dirname(uri), dep)
+                try:
+                    deps.append(ruta_uri(raiz, dep))
+                except ValueError:
+                    pass
+        # Solo como comentario propio al principio: no vale dentro de un texto o más abajo
+        admite = all(linea.strip() != MARCA_SIN_CACHE for linea in fuente.splitlines()[:LINEAS_MARCA])
+        with self.lock:
+            self.directas[ruta] = (firma, deps, admite)
+        return deps, admite
+
+    def admite_cache(self, ruta):
+        """False si ruta lleva MARCA_SIN_CACHE; solo relee el archivo si ha cambiado."""
+        st = os.stat(ruta)
+        return self.analizar(ruta, (st.st_ino, st.st_size, st.st_mtime_ns))[1]
+
+    def firma_completa(self, ruta):
+        firmas = {}
+        pendientes = [ruta]
+        while pendientes:
+            actual = pendientes.pop()
+            if actual in firmas:
+                continue
+            try:
+                st = os.stat(actual)
+            except OSError:
+                firmas[actual] = None
+                continue
+            firmas[actual] = (st.st_ino, st.st_size, st.st_mtime_ns)
+            pendientes.extend(self.analizar(actual, firmas[actual])[0])
+        return tuple(sorted(firmas.items()))
+
+DEPENDENCIAS = DependenciasTemplates()
+
+CALIENTES = []  # templates que cada proceso de render carga al arrancar (ver --calentar)
+
+def iniciar_proceso_render():
+    """Inicializador de cada proceso del pool de render; devuelve la caché con la que renderiza."""
+    global CACHE_TEMPLATES, LOOKUPS, LOOKUPS_LOCK
+    # Caché y locks nuevos: los heredados del fork pueden haber quedado tomados por otro hilo
+    CACHE_TEMPLATES = CacheTemplates(MAX_TEMPLATES, compilar_template)
+    LOOKUPS, LOOKUPS_LOCK = {}, threading.Lock()
+    calentar_templates(CALIENTES)
+    return CACHE_TEMPLATES
+
+POOL_RENDER = None  # se crea al arrancar si se piden procesos de render
+
+def renderizar(ruta, **contexto):
+    """Renderiza en POOL_RENDER si está activo; si no, en el hilo actual."""
+    if POOL_RENDER is None:
+        return str(CACHE_TEMPLATES.obtener(ruta).render(**contexto))
+    return POOL_RENDER.render(ruta, contexto)
+
+def precompilar_uno(ruta, modulos_dir):
+    """Compila un .mako dentro de un proceso del pool; devuelve (ruta, error, segundos)."""
+    global MODULOS_DIR
+    MODULOS_DIR = modulos_dir
+    inicio = time.perf_counter()
+    try:
+        compilar_template(ruta, os.stat(ruta))
+        error = None
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    return ruta, error, time.perf_counter() - inicio
+
+def templates_de_usuarios():
+    """Rutas ordenadas de los .mako de USERS_BASE/*/htdocs.
+
+    Recorre las carpetas directamente con os.scandir, sin pasar por
+    INDICE_PUBLICADOS: precompilar no debe construir el índice ni el catálogo
+    ni lanzar su vigilancia en el proceso maestro.
+    """
+    pendientes = []
+    try:
+        with os.scandir(USERS_BASE) as it:
+            pendientes = [os.path.join(e.path, "htdocs") for e in it if e.is_dir()]
+    except OSError:
+        return []
+    rutas, vistas = [], set()
+    while pendientes:
+        carpeta = pendientes.pop()
+        real = os.path.realpath(carpeta)
+        if real in vistas:
+            continue  # enlace que vuelve a una carpeta ya recorrida
+        vistas.add(real)
+        try:
+            with os.scandir(carpeta) as it:
+                for entrada in it:
+                    try:
+                        if entrada.is_dir():
+                            pendientes.append(entrada.path)
+                        elif entrada.name.endswith(".mako") and entrada.is_file():
+                            rutas.append(entrada.path)
+                    except OSError:
+                        pass
+        except OSError:
+            pass
+    return sorted(rutas)
+
+def precompilar_templates(procesos=None):
+    """Compila en paralelo todos los .mako de USERS_BASE/*/htdocs.
+
+    Los módulos quedan en MODULOS_DIR, donde los reutilizan este proceso, los
+    workers, los procesos de render y los siguientes arranques. Devuelve
+    (cuántos fallaron, rutas compiladas sin error).
+    """
+    rutas = templates_de_usuarios()
+    procesos = procesos or os.cpu_count() or 1
+    inicio = time.perf_counter()
+    fallos = []
+    lentos = []
+    with ProcessPoolExecutor(max_workers=procesos) as pool:
+        for ruta, error, segundos in pool.map(precompilar_uno, rutas, itertools.repeat(MODULOS_DIR),
+                                              chunksize=16):
+            if error:
+                fallos.append((ruta, error))
+            lentos.append((segundos, ruta))
+    total = time.perf_counter() - inicio
+    print(f"Precompilados {len(rutas) - len(fallos)}/{len(rutas)} templates en {total:.2f}s "
+          f"con {procesos} procesos")
+    for segundos, ruta in sorted(lentos, reverse=True)[:5]:
+        print(f"  {segundos:.3f}s  {os.path.relpath(ruta, USERS_BASE)}")
+    for ruta, error in fallos:
+        print(f"  ERROR {os.path.relpath(ruta, USERS_BASE)}: {error}")
+    errores = {ruta for ruta, _ in fallos}
+    return len(fallos), [r for r in rutas if r not in errores]
+
+def calentar_templates(rutas):
+    """Carga en CACHE_TEMPLATES (hasta llenarla) templates ya compilados en MODULOS_DIR."""
+    for ruta in rutas[:MAX_TEMPLATES]:
+        try:
+            CACHE_TEMPLATES.obtener(ruta)
+        except Exception:
+            pass
+
+class FTPWebHandler(ManejadorBase):
+    cache_paginas = CACHE_PAGINAS
+    comprimidos = COMPRIMIDOS
+    catalogo = CATALOGO
+
     def translate_path(self, path):
         path = path.split('?',1)[0]
         path = path.split('#',1)[0]
@@ -114,7 +424,7 @@ class FTPWebHandler(http.server.SimpleHTTPRequestHandler):
             self.redirect("/servidores")
             return
         if parsed.path == "/servidores":
-            self.serve_servidores()
+            self.serve_servidores(parse_qs(parsed.query))
             return
         if parsed.path.startswith("/web/"):
             # /web/usuario/ -> index.html/mako
@@ -127,6 +437,9 @@ class FTPWebHandler(http.server.SimpleHTTPRequestHandler):
                     subruta = unquote(partes[2])
                 self.serve_web_file(usuario, subruta)
                 return
+        if parsed.path == "/estado":
+            self.serve_estado()
+            return
         if parsed.path == "/login":
             self.serve_login()
             return
@@ -135,6 +448,7 @@ class FTPWebHandler(http.server.SimpleHTTPRequestHandler):
             self.send_response(302)
             self.send_header("Set-Cookie", "sessionid=; Path=/; Max-Age=0")
             self.send_header("Location", "/login")
+            self.send_header("Content-Length", "0")
             self.end_headers()
             return
         if parsed.path == "/nuevo_usuario":
@@ -143,36 +457,27 @@ class FTPWebHandler(http.server.SimpleHTTPRequestHandler):
         # Aquí iría la lógica de editor/FTP, omítela si solo quieres la parte web.
         self.send_error(404, "No encontrado")
 
-    def serve_servidores(self):
-        """Muestra todos los htdocs de todos los usuarios como enlaces web."""
-        htdocs = listar_htdocs()
-        filas = []
-        for user, archivos in sorted(htdocs.items()):
-            filas.append(f"<h3>{user}</h3><ul>")
-            idx = encontrar_index(user)
-            if idx:
-                filas.append(f'<li><a href="/web/{user}/">{user}/htdocs/ (index)</a></li>')
-            for f in sorted(archivos):
-                if f == idx:
-                    continue
-                filas.append(f'<li><a href="/web/{user}/{f}">{f}</a></li>')
-            filas.append("</ul>")
-        if not filas:
-            filas.append("<p>No hay webs de usuarios aún.</p>")
-        html = f"""
-<!DOCTYPE html>
-<html><head><title>Servidores web de usuarios</title><meta charset="utf-8"/></head>
-<body>
-<h2>Servidores web de usuarios</h2>
-<p>Aquí aparecen todos los archivos .html y .mako en htdocs de cada usuario.<br/>
-Puedes enlazar directamente a <code>/web/usuario/archivo</code> o a <code>/web/usuario/</code> para el index.</p>
-{''.join(filas)}
-</body></html>
-"""
-        self.send_response(200)
-        self.send_header("Content-Type", "text/html; charset=utf-8")
-        self.end_headers()
-        self.wfile.write(html.encode("utf-8"))
+    def serve_servidores(self, params):
+        """Muestra los htdocs de los usuarios como enlaces web, paginados por usuario.
+
+        ?prefijo= filtra por inicio del nombre de usuario, ?q= busca en nombres
+        de usuario y de archivo y ?pagina= elige la página. La página sale de
+        CACHE_SERVIDORES y lleva ETag del contenido (304 si no ha cambiado).
+        """
+        prefijo = params.get("prefijo", [""])[0].strip()
+        texto = params.get("q", [""])[0].strip()
+        try:
+            pagina = max(1, int(params.get("pagina", ["1"])[0]))
+        except ValueError:
+            pagina = 1
+        cuerpo, etag = CACHE_SERVIDORES.obtener((prefijo, texto, pagina),
+                                                lambda: pagina_servidores(prefijo, texto, pagina))
+        if self.etag_coincide(etag):
+            self.enviar_cabeceras(304, {"ETag": etag, "Cache-Control": "no-cache"})
+            return
+        self.enviar_cabeceras(200, {"Content-Type": "text/html; charset=utf-8", "Content-Length": str(len(cuerpo)),
+                                    "ETag": etag, "Cache-Control": "no-cache"})
+        self.wfile.write(cuerpo)
 
     def serve_web_file(self, usuario, subruta):
         """Sirve archivos .html o .mako como web, o index si subruta es carpeta."""
@@ -181,7 +486,9 @@ Puedes enlazar directamente a <code>/web/usuario/archivo</code> o a <code>/web/u
             self.send_error(404, "Usuario o htdocs no existen")
             return
         fs_path = safe_join(htdocs, subruta)
-        if os.path.isdir(fs_path):
+        # Un archivo que el catálogo conoce al día existe: no hace falta preguntárselo al disco
+        conocido = CATALOGO.metadatos(fs_path) is not None
+        if not conocido and os.path.isdir(fs_path):
             idx = encontrar_index(usuario, subruta)
             if idx:
                 fs_path = os.path.join(fs_path, idx)
@@ -189,33 +496,49 @@ Puedes enlazar directamente a <code>/web/usuario/archivo</code> o a <code>/web/u
             else:
                 self.listar_dir_web(usuario, subruta)
                 return
-        if not os.path.isfile(fs_path):
+        if not conocido and not os.path.isfile(fs_path):
             self.send_error(404, "Archivo no encontrado")
             return
         if fs_path.endswith(".html"):
-            with open(fs_path, "r", encoding="utf-8") as f:
-                contenido = f.read()
-            self.send_response(200)
-            self.send_header("Content-Type", "text/html; charset=utf-8")
-            self.end_headers()
-            self.wfile.write(contenido.encode("utf-8"))
+            self.enviar_archivo(fs_path, "text/html; charset=utf-8")
         elif fs_path.endswith(".mako"):
             if Template is None:
                 self.send_error(500, "Mako no instalado")
                 return
-            with open(fs_path, "r", encoding="utf-8") as f:
-                plantilla = f.read()
-            try:
-                html = Template(plantilla).render()
-            except Exception as e:
-                html = f"<pre>Error de Mako: {e}</pre>"
-            self.send_response(200)
-            self.send_header("Content-Type", "text/html; charset=utf-8")
-            self.end_headers()
-            self.wfile.write(str(html).encode("utf-8"))
+            self.serve_mako(fs_path)
         else:
             self.send_error(403, "Solo se sirven archivos .html o .mako")
 
+    def serve_mako(self, fs_path):
+        """Renderiza un .mako sin contexto; con CACHE_SALIDA_TTL reutiliza la salida durante ese tiempo."""
+        firma = None
+        if CACHE_SALIDA_TTL > 0:
+            # Incluye layouts e includes: si cambia uno, la salida guardada deja de valer
+            firma = DEPENDENCIAS.firma_completa(fs_path)
+            guardada = CACHE_SALIDA.obtener(fs_path, firma)
+            if guardada is not None:
+                cuerpo, cabeceras = guardada
+                self.enviar_cabeceras(200, cabeceras)
+                self.wfile.write(cuerpo)
+                return
+        try:
+            html = renderizar(fs_path)
+        except RenderTimeout as e:
+            self.send_error(504, f"Template demasiado lento: {e}")
+            return
+        except RenderOcupado as e:
+            self.enviar_ocupado(str(e))
+            return
+        except Exception as e:
+            self.enviar_html(f"<pre>Error de Mako: {e}</pre>")
+            return
+        cuerpo = str(html).encode("utf-8")
+        cabeceras = {"Content-Type": "text/html; charset=utf-8", "Content-Length": str(len(cuerpo))}
+        if firma is not None and DEPENDENCIAS.admite_cache(fs_path):
+            CACHE_SALIDA.guardar(fs_path, firma, cuerpo, cabeceras, CACHE_SALIDA_TTL)
+        self.enviar_cabeceras(200, cabeceras)
+        self.wfile.write(cuerpo)
+
     def listar_dir_web(self, usuario, subruta):
         """Lista los archivos y subcarpetas en htdocs de usuario/subruta."""
         htdocs = os.path.join(USERS_BASE, usuario, "htdocs")
@@ -223,15 +546,8 @@ Puedes enlazar directamente a <code>/web/usuario/archivo</code> o a <code>/web/u
         if not os.path.isdir(fs_path):
             self.send_error(404, "No es carpeta")
             return
-        items = os.listdir(fs_path)
-        files = []
-        dirs = []
-        for name in items:
-            full = os.path.join(fs_path, name)
-            if os.path.isdir(full):
-                dirs.append(name)
-            elif name.endswith(".html") or name.endswith(".mako"):
-                files.append(name)
+        _, dirs, archivos = LISTADOS.listar(fs_path)
+        files = [name for name in archivos if es_htmlo_mako(name)]
         rel = subruta.rstrip("/")
         if rel:
             arriba = f'<a href="/web/{usuario}/{os.path.dirname(rel)}">⬆️ Subir</a>'
@@ -245,17 +561,14 @@ Puedes enlazar directamente a <code>/web/usuario/archivo</code> o a <code>/web/u
 {arriba}
 <ul>
 """
-        for d in sorted(dirs):
+        for d in dirs:
             url = f"/web/{usuario}/{(rel + '/' if rel else '') + d}"
             html += f'<li><b><a href="{url}">{d}/</a></b></li>'
-        for f in sorted(files):
+        for f in files:
             url = f"/web/{usuario}/{(rel + '/' if rel else '') + f}"
             html += f'<li><a href="{url}">{f}</a></li>'
         html += "</ul></body></html>"
-        self.send_response(200)
-        self.send_header("Content-Type", "text/html; charset=utf-8")
-        self.end_headers()
-        self.wfile.write(html.encode("utf-8"))
+        self.enviar_html(html)
 
     def serve_login(self, mensaje=""):
         html = f"""
@@ -272,10 +585,7 @@ Puedes enlazar directamente a <code>/web/usuario/archivo</code> o a <code>/web/u
 <p>¿No tienes cuenta? <a href="/nuevo_usuario">Regístrate</a></p>
 </body></html>
 """
-        self.send_response(200)
-        self.send_header("Content-Type", "text/html; charset=utf-8")
-        self.end_headers()
-        self.wfile.write(html.encode("utf-8"))
+        self.enviar_html(html)
 
     def serve_nuevo_usuario(self, mensaje=""):
         html = f"""
@@ -292,19 +602,107 @@ Puedes enlazar directamente a <code>/web/usuario/archivo</code> o a <code>/web/u
 <p><a href="/login">Volver a login</a></p>
 </body></html>
 """
-        self.send_response(200)
-        self.send_header("Content-Type", "text/html; charset=utf-8")
-        self.end_headers()
-        self.wfile.write(html.encode("utf-8"))
+        self.enviar_html(html)
+
+    def serve_estado(self):
+        """Contadores internos en JSON (aciertos/fallos de las cachés...); solo desde esta máquina."""
+        if not self.cliente_local():
+            self.send_error(403, "El estado solo se consulta desde el propio servidor")
+            return
+        cuerpo = json.dumps({"cache_paginas": CACHE_PAGINAS.estadisticas(),
+                             "cache_servidores": CACHE_SERVIDORES.estadisticas(),
+                             "listados": LISTADOS.estadisticas(),
+                             "cache_salida": CACHE_SALIDA.estadisticas(),
+                             "cache_templates": CACHE_TEMPLATES.estadisticas()}).encode("utf-8")
+        self.enviar_cabeceras(200, {"Content-Type": "application/json",
+                                    "Content-Length": str(len(cuerpo)),
+                                    "Cache-Control": "no-store"})
+        self.wfile.write(cuerpo)
 
     def redirect(self, path):
         self.send_response(302)
         self.send_header("Location", path)
+        self.send_header("Content-Length", "0")
         self.end_headers()
 
+def crear_servidor(direccion, args, sock=None):
+    """Crea el servidor del motor elegido; si se da sock, escucha en ese socket ya abierto."""
+    if POOL_RENDER is not None:
+        POOL_RENDER.arrancar()  # los procesos de render se crean antes de que haya hilos
+    # El índice de /servidores se construye ya, en segundo plano, no en la primera petición
+    threading.Thread(target=INDICE_PUBLICADOS.iniciar, daemon=True).start()
+    if args.motor == "pool":
+        httpd = ServidorPoolHilos(direccion, FTPWebHandler, hilos=args.hilos, cola=args.cola,
+                                  pila_kb=args.pila_kb, bind_and_activate=sock is None)
+    else:
+        httpd = socketserver.ThreadingTCPServer(direccion, FTPWebHandler, bind_and_activate=sock is None)
+    if sock is not None:
+        httpd.socket.close()
+        httpd.socket = sock
+    return httpd
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Servidor FTP Web (htdocs por usuario)")
+    parser.add_argument("--motor", choices=("hilos", "pool"), default="hilos",
+                        help="hilos: un hilo por conexión; pool: hilos fijos y cola acotada")
+    parser.add_argument("--hilos", type=int, default=HILOS_POOL,
+                        help="motor pool: número fijo de hilos")
+    parser.add_argument("--cola", type=int, default=COLA_POOL,
+                        help="motor pool: conexiones en espera antes de responder 503")
+    parser.add_argument("--pila-kb", type=int, default=PILA_HILO_KB,
+                        help="motor pool: tamaño de pila de cada hilo en KiB")
+    parser.add_argument("--procesos", type=int, default=1,
+                        help="workers pre-fork (más de 1 usa varios núcleos)")
+    parser.add_argument("--reuseport", action="store_true",
+                        help="en pre-fork, un socket SO_REUSEPORT por worker")
+    parser.add_argument("--modulos-dir", default=MODULOS_DIR,
+                        help="carpeta donde se guardan los templates .mako compilados")
+    parser.add_argument("--cache-salida", type=float, default=CACHE_SALIDA_TTL, metavar="SEGUNDOS",
+                        help=f"reutiliza la salida de los .mako durante SEGUNDOS "
+                             f"(las páginas con '{MARCA_SIN_CACHE}' quedan fuera)")
+    parser.add_argument("--render-procesos", type=int, default=0,
+                        help="renderiza los .mako en N procesos aislados (0 = en el hilo de la petición)")
+    parser.add_argument("--render-tiempo", type=float, default=RENDER_TIEMPO_MAX,
+                        help="segundos de reloj por render aislado")
+    parser.add_argument("--render-cpu", type=int, default=RENDER_CPU_MAX,
+                        help="segundos de CPU por render aislado")
+    parser.add_argument("--render-memoria-mb", type=int, default=RENDER_MEMORIA_MB,
+                        help="memoria máxima de cada proceso de render")
+    parser.add_argument("--precompilar", action="store_true",
+                        help="compila todos los .mako de usuarios/*/htdocs y termina")
+    parser.add_argument("--calentar", action="store_true",
+                        help="compila todos los .mako antes de empezar a servir")
+    parser.add_argument("--procesos-compilacion", type=int, default=None,
+                        help="procesos para --precompilar/--calentar (por defecto, uno por núcleo)")
+    args = parser.parse_args()
+    MODULOS_DIR = os.path.abspath(args.modulos_dir)
+    CACHE_SALIDA_TTL = args.cache_salida
+    if args.render_procesos > 0 and hasattr(os, "fork"):
+        POOL_RENDER = PoolRender(args.render_procesos, iniciar_proceso_render, args.render_tiempo,
+                                 args.render_cpu, args.render_memoria_mb)
+    if args.precompilar or args.calentar:
+        if Template is None:
+            print("Mako no instalado: no hay templates que precompilar.")
+            fallos, compilados = 0, []
+        else:
+            fallos, compilados = precompilar_templates(args.procesos_compilacion)
+        if args.precompilar:
+            sys.exit(1 if fallos else 0)
+        # Se calienta la caché que va a renderizar: la de los procesos de render si los hay
+        # (la cargan al arrancar) o la de este proceso, que heredan los workers del pre-fork
+        if POOL_RENDER is not None:
+            CALIENTES[:] = compilados[:MAX_TEMPLATES]
+        else:
+            calentar_templates(compilados)
     PORT = 8000
-    with socketserver.ThreadingTCPServer(("", PORT), FTPWebHandler) as httpd:
-        print(f"Servidor FTP Web corriendo en http://localhost:{PORT}/")
-        print("Cada usuario tiene su propia carpeta htdocs para webs.")
-        httpd.serve_forever()
\ No newline at end of file
+    print(f"Servidor FTP Web corriendo en http://localhost:{PORT}/")
+    print("Cada usuario tiene su propia carpeta htdocs para webs.")
+    if args.procesos > 1 and hasattr(os, "fork"):
+        # Las sesiones van a SESSIONS_DIR para que las vean todos los workers
+        SESIONES_COMPARTIDAS = True
+        os.makedirs(SESSIONS_DIR, exist_ok=True)
+        prefork(("", PORT), args.procesos, args.reuseport,
+                lambda sock: crear_servidor(("", PORT), args, sock))
+    else:
+        with crear_servidor(("", PORT), args) as httpd:
+            httpd.serve_forever()
\ No newline at end of file
@@ -0,0 +1,1604 @@
+"""Piezas compartidas por apacheFTP, apachePuro y el servidor Mako (v0.0.115).
+
+Cada script la importa desde su misma carpeta; lo que depende de sus
+carpetas o de su configuración se le pasa como parámetro.
+"""
+import http.server
+import socketserver
+import email.utils
+import ipaddress
+import struct
+import hashlib
+from collections import OrderedDict
+import gzip, shutil, sqlite3, bisect
+from multiprocessing.connection import Connection
+import os, socket, selectors, signal, time, queue, threading, traceback
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    from mako.lookup import TemplateLookup
+    from mako import exceptions as mako_exceptions
+except ImportError:
+    TemplateLookup = object  # solo para poder definir LookupSitio sin Mako
+try:
+    from watchdog.observers import Observer
+except ImportError:
+    Observer = None  # el índice de publicados revisa mtimes de carpetas cada INDICE_INTERVALO
+try:
+    import resource
+except ImportError:
+    resource = None
+
+TIEMPO_INACTIVO = 15          # segundos que una conexión keep-alive puede estar ociosa
+MAX_PETICIONES_CONEXION = 100 # peticiones por conexión antes de cerrarla
+HILOS_POOL = 64              # motor pool: hilos fijos que atienden conexiones
+COLA_POOL = 256              # motor pool: conexiones en espera antes de responder 503
+PILA_HILO_KB = 0             # motor pool: tamaño de pila por hilo (0 = el del sistema)
+RETRY_AFTER = 5              # segundos que se sugieren al cliente en el 503
+TAM_BLOQUE = 64 * 1024       # bloque de copia cuando no se puede usar sendfile
+MAX_RANGOS = 16              # más rangos que esto en un Range se ignoran (se envía todo)
+RENDER_TIEMPO_MAX = 5         # render aislado: segundos de reloj por render (504 si se pasa)
+RENDER_CPU_MAX = 5            # render aislado: segundos de CPU por render
+RENDER_MEMORIA_MB = 1024      # render aislado: memoria máxima de cada proceso
+RENDER_TAREAS_POR_PROCESO = 200   # render aislado: renders antes de reciclar el proceso
+RENDER_PENDIENTES_POR_PROCESO = 8 # render aislado: renders en espera antes de responder 503
+LISTADO_MARGEN = 1           # segundos: un mtime más reciente no sirve para validar cachés
+CATALOGO_VERSION = 2         # esquema del catálogo SQLite; otro número lo rehace
+INDICE_INTERVALO = 2         # segundos entre revisiones del índice de publicados sin watchdog
+USUARIOS_POR_PAGINA = 50     # /servidores: usuarios por página
+CONSULTAS_MAX = 256          # /servidores: páginas filtradas que se recuerdan
+COMPRESION_MIN_BYTES = 1024
+COMPRESION_EXCLUIDAS = {".mp4", ".webm", ".png", ".jpg", ".jpeg", ".gif", ".webp",
+                        ".ico", ".zip", ".gz", ".br", ".pdf"}
+
+def parsear_rangos(cabecera, tamano):
+    """Convierte un Range 'bytes=0-99,-500' en [(inicio, fin)] con fin inclusivo.
+
+    Devuelve None si la cabecera no es válida (se ignora) y [] si ningún
+    rango cae dentro del archivo (416).
+    """
+    unidad, _, especificacion = cabecera.partition("=")
+    if unidad.strip().lower() != "bytes":
+        return None
+    rangos = []
+    for parte in especificacion.split(","):
+        parte = parte.strip()
+        if not parte:
+            continue
+        inicio, guion, fin = parte.partition("-")
+        if not guion:
+            return None
+        try:
+            if not inicio.strip():
+                # Rango sufijo: los últimos N bytes
+                n = int(fin)
+                if n <= 0:
+                    continue
+                rangos.append((max(tamano - n, 0), tamano - 1))
+                continue
+            inicio = int(inicio)
+            fin = int(fin) if fin.strip() else None
+        except ValueError:
+            return None
+        if inicio < 0 or (fin is not None and fin < inicio):
+            return None
+        if inicio >= tamano:
+            continue
+        rangos.append((inicio, tamano - 1 if fin is None else min(fin, tamano - 1)))
+    return rangos
+
+# Cache-Control por extensión; "" es la política para el resto
+POLITICA_CACHE = {
+    ".html": "no-cache",
+    ".htm": "no-cache",
+    ".css": "public, max-age=3600",
+    ".js": "public, max-age=3600",
+    ".png": "public, max-age=86400",
+    ".jpg": "public, max-age=86400",
+    ".gif": "public, max-age=86400",
+    ".mp4": "public, max-age=86400",
+    "": "no-cache",
+}
+
+def calcular_etag(st):
+    """ETag fuerte a partir de inodo, tamaño y mtime: cambia con cualquier escritura."""
+    return f'"{st.st_ino:x}-{st.st_size:x}-{st.st_mtime_ns:x}"'
+
+def politica_cache(ruta):
+    return POLITICA_CACHE.get(os.path.splitext(ruta)[1].lower(), POLITICA_CACHE[""])
+
+def codificaciones_disponibles():
+    return ("br", "gzip") if brotli is not None else ("gzip",)
+
+def comprimible(ruta, tamano):
+    return tamano >= COMPRESION_MIN_BYTES and os.path.splitext(ruta)[1].lower() not in COMPRESION_EXCLUIDAS
+
+def elegir_codificacion(accept_encoding):
+    """'br' o 'gzip' según Accept-Encoding (respetando q=0); None si no acepta ninguna."""
+    aceptadas = {}
+    for parte in accept_encoding.split(","):
+        nombre, _, parametros = parte.strip().partition(";")
+        q = 1.0
+        parametros = parametros.strip()
+        if parametros.startswith("q="):
+            try:
+                q = float(parametros[2:])
+            except ValueError:
+                q = 0.0
+        aceptadas[nombre.strip().lower()] = q
+    for codificacion in codificaciones_disponibles():
+        if aceptadas.get(codificacion, aceptadas.get("*", 0)) > 0:
+            return codificacion
+    return None
+
+def dentro_de(ruta, base):
+    """True si ruta, con los enlaces y '..' resueltos, queda dentro de base."""
+    base = os.path.realpath(base)
+    return os.path.commonpath([os.path.realpath(ruta), base]) == base
+
+def ruta_uri(raiz, uri):
+    """Ruta en disco de una URI de Mako; ValueError si sale de raiz."""
+    ruta = os.path.abspath(os.path.join(raiz, *[p for p in uri.split("/") if p]))
+    if not dentro_de(ruta, raiz):
+        raise ValueError("Intento de acceso fuera del directorio permitido.")
+    return ruta
+
+class LookupSitio(TemplateLookup):
+    """Lookup de Mako para un sitio (el htdocs de un usuario o toda la web).
+
+    Resuelve <%inherit>, <%include> y <%namespace file=...> sin salir de raiz
+    y pasa por plantillas (una CacheTemplates), así un layout se compila una
+    vez y lo comparten todas las páginas del sitio; si cambia, se recompila
+    solo él.
+    """
+    def __init__(self, raiz, plantillas):
+        super().__init__(directories=[raiz])
+        self.raiz = raiz
+        self.plantillas = plantillas
+
+    def get_template(self, uri):
+        try:
+            ruta = ruta_uri(self.raiz, uri)
+        except ValueError:
+            raise mako_exceptions.TopLevelLookupException(f"Template fuera del sitio: {uri}")
+        if not os.path.isfile(ruta):
+            raise mako_exceptions.TopLevelLookupException(f"No existe el template {uri}")
+        return self.plantillas.obtener(ruta)
+
+def mtime_fiable(mtime_ns):
+    """mtime_ns si ya es lo bastante viejo para validar con él una caché, o None.
+
+    El mtime de los sistemas de archivos avanza a saltos: un cambio justo
+    después de leer una carpeta puede dejarle el mismo mtime y la caché no
+    se enteraría. Por eso no se confía en mtimes de hace menos de
+    LISTADO_MARGEN segundos.
+    """
+    return mtime_ns if time.time_ns() - mtime_ns > LISTADO_MARGEN * 1_000_000_000 else None
+
+class ListadoCarpetas:
+    """Contenido de carpetas leído con os.scandir y guardado por carpeta.
+
+    scandir ya trae el tipo de cada entrada (d_type), así que separar
+    carpetas de archivos no cuesta un stat por entrada. Un listado se
+    reutiliza mientras no cambie el mtime de su carpeta (crear, borrar o
+    renombrar algo dentro lo cambia). Guarda como mucho max_carpetas (LRU).
+    """
+    def __init__(self, max_carpetas):
+        self.max_carpetas = max_carpetas
+        self.entradas = OrderedDict()  # carpeta -> (mtime_ns, subcarpetas, archivos, enlaces a carpetas)
+        self.aciertos = 0
+        self.fallos = 0
+        self.lock = threading.Lock()
+        os.register_at_fork(after_in_child=self.tras_fork)
+
+    def tras_fork(self):
+        self.lock = threading.Lock()
+
+    def listar(self, carpeta, enlaces=True):
+        """(mtime_ns, subcarpetas, archivos) de carpeta, con los nombres ordenados; OSError si no se puede leer.
+
+        Los enlaces a carpetas cuentan como subcarpetas, como con os.path.isdir;
+        con enlaces=False se omiten (así recorre os.walk, sin riesgo de bucles).
+        """
+        carpeta = os.path.abspath(carpeta)
+        mtime = os.stat(carpeta).st_mtime_ns
+        with self.lock:
+            guardado = self.entradas.get(carpeta)
+            if guardado is not None and guardado[0] == mtime:
+                self.entradas.move_to_end(carpeta)
+                self.aciertos += 1
+            else:
+                guardado = None
+                self.fallos += 1
+        if guardado is None:
+            subcarpetas, archivos, con_enlace = [], [], set()
+            with os.scandir(carpeta) as it:
+                for entrada in it:
+                    try:
+                        if entrada.is_dir():
+                            subcarpetas.append(entrada.name)
+                            if entrada.is_symlink():
+                                con_enlace.add(entrada.name)
+                        elif entrada.is_file():
+                            archivos.append(entrada.name)
+                    except OSError:
+                        pass
+            guardado = (mtime, tuple(sorted(subcarpetas)), tuple(sorted(archivos)), frozenset(con_enlace))
+            if mtime_fiable(mtime) is not None:
+                with self.lock:
+                    self.entradas[carpeta] = guardado
+                    self.entradas.move_to_end(carpeta)
+                    while len(self.entradas) > self.max_carpetas:
+                        self.entradas.popitem(last=False)
+        mtime, subcarpetas, archivos, con_enlace = guardado
+        if not enlaces and con_enlace:
+            subcarpetas = tuple(n for n in subcarpetas if n not in con_enlace)
+        return mtime, subcarpetas, archivos
+
+    def estadisticas(self):
+        with self.lock:
+            return {"carpetas": len(self.entradas), "aciertos": self.aciertos, "fallos": self.fallos}
+
+def resumir(ruta, tamano, mtime_ns):
+    """sha1 en hexadecimal de ruta, o None si ya no tiene ese tamaño y mtime (o no se puede leer)."""
+    resumen = hashlib.sha1()
+    try:
+        with open(ruta, "rb") as f:
+            for bloque in iter(lambda: f.read(TAM_BLOQUE), b""):
+                resumen.update(bloque)
+            st = os.fstat(f.fileno())
+    except OSError:
+        return None
+    if st.st_size != tamano or st.st_mtime_ns != mtime_ns:
+        return None
+    return resumen.hexdigest()
+
+class CatalogoArchivos:
+    """Catálogo persistente (SQLite) de las carpetas de los usuarios y de sus archivos.
+
+    Guarda el mtime de cada carpeta y, de cada archivo, tamaño, mtime, sha1
+    y si se publica. Al arrancar, IndicePublicados se carga desde aquí y
+    solo vuelve a leer las carpetas cuyo mtime ha cambiado; de ellas solo
+    se vuelve a calcular el sha1 de los archivos cuyo tamaño o mtime no
+    coincide. Cada servidor usa su propio archivo, porque no publican lo
+    mismo. Cada proceso abre su conexión (los workers del pre-fork
+    comparten el archivo en modo WAL) y tiene en memoria los datos de los
+    archivos publicables, para que metadatos() no toque el disco.
+    """
+    def __init__(self, ruta):
+        self.ruta = ruta
+        self.conexion = None
+        self.publicados = {}   # ruta -> (tamaño, mtime_ns, sha1) de cada archivo publicable
+        self.al_dia = False    # True mientras watchdog avisa a IndicePublicados de cada cambio
+        self.lock = threading.Lock()
+        os.register_at_fork(after_in_child=self.tras_fork)
+
+    def tras_fork(self):
+        # La conexión y el lock del padre no se pueden usar en el hijo, ni su watchdog le avisa
+        self.conexion = None
+        self.al_dia = False
+        self.lock = threading.Lock()
+
+    def abrir(self):
+        # Llamar con self.lock tomado
+        if self.conexion is None:
+            os.makedirs(os.path.dirname(self.ruta), exist_ok=True)
+            self.conexion = sqlite3.connect(self.ruta, timeout=30, check_same_thread=False)
+            self.conexion.execute("PRAGMA journal_mode=WAL")
+            self.conexion.execute("PRAGMA synchronous=NORMAL")
+            with self.conexion:
+                self.conexion.execute("BEGIN IMMEDIATE")
+                # Un catálogo de un esquema anterior no sirve: se rehace desde el disco
+                if self.conexion.execute("PRAGMA user_version").fetchone()[0] != CATALOGO_VERSION:
+                    self.conexion.execute("DROP TABLE IF EXISTS carpetas")
+                    self.conexion.execute("DROP TABLE IF EXISTS archivos")
+                    self.conexion.execute("CREATE TABLE carpetas ("
+                                          "ruta TEXT PRIMARY KEY, padre TEXT, mtime_ns INTEGER)")
+                    self.conexion.execute("CREATE TABLE archivos ("
+                                          "carpeta TEXT, nombre TEXT, tamano INTEGER, mtime_ns INTEGER, "
+                                          "sha1 TEXT, publicable INTEGER, PRIMARY KEY (carpeta, nombre))")
+                    self.conexion.execute(f"PRAGMA user_version = {CATALOGO_VERSION}")
+        return self.conexion
+
+    def cargar(self):
+        """Dict carpeta -> (mtime_ns, archivos publicables, subcarpetas) tal como quedó guardado."""
+        with self.lock:
+            db = self.abrir()
+            filas = db.execute("SELECT ruta, padre, mtime_ns FROM carpetas").fetchall()
+            publicables = db.execute("SELECT carpeta, nombre, tamano, mtime_ns, sha1 FROM archivos "
+                                     "WHERE publicable").fetchall()
+            for carpeta, nombre, tamano, mtime, resumen in publicables:
+                if resumen is not None:
+                    self.publicados[os.path.join(carpeta, nombre)] = (tamano, mtime, resumen)
+        archivos, subcarpetas = {}, {}
+        for carpeta, nombre, _, _, _ in publicables:
+            archivos.setdefault(carpeta, set()).add(nombre)
+        for ruta, padre, _ in filas:
+            if padre:
+                subcarpetas.setdefault(padre, set()).add(os.path.basename(ruta))
+        return {ruta: (mtime, frozenset(archivos.get(ruta, ())), frozenset(subcarpetas.get(ruta, ())))
+                for ruta, _, mtime in filas}
+
+    def actualizar_carpeta(self, carpeta, padre, mtime_ns, archivos, publicables):
+        """Guarda una carpeta recién leída; archivos es nombre -> (tamaño, mtime_ns).
+
+        Devuelve False si algún archivo se quedó sin sha1 (su mtime aún no es
+        fiable o cambió mientras se leía); la carpeta se guarda entonces sin
+        mtime, para que la próxima revisión la vuelva a leer.
+        """
+        with self.lock:
+            db = self.abrir()
+            previos = {nombre: datos for nombre, *datos in db.execute(
+                "SELECT nombre, tamano, mtime_ns, sha1 FROM archivos WHERE carpeta = ?", (carpeta,))}
+        filas = []
+        for nombre, (tamano, mtime) in archivos.items():
+            previo = previos.get(nombre)
+            if previo is not None and previo[0] == tamano and previo[1] == mtime and previo[2] is not None:
+                resumen = previo[2]
+            elif mtime_fiable(mtime) is not None:
+                resumen = resumir(os.path.join(carpeta, nombre), tamano, mtime)
+            else:
+                resumen = None
+            filas.append((carpeta, nombre, tamano, mtime, resumen, nombre in publicables))
+        completa = all(fila[4] is not None for fila in filas)
+        with self.lock:
+            db = self.abrir()
+            with db:
+                db.execute("INSERT OR REPLACE INTO carpetas VALUES (?, ?, ?)",
+                           (carpeta, padre, mtime_ns if completa else None))
+                db.execute("DELETE FROM archivos WHERE carpeta = ?", (carpeta,))
+                db.executemany("INSERT INTO archivos VALUES (?, ?, ?, ?, ?, ?)", filas)
+            for nombre in previos:
+                self.publicados.pop(os.path.join(carpeta, nombre), None)
+            for _, nombre, tamano, mtime, resumen, publicable in filas:
+                if publicable and resumen is not None:
+                    self.publicados[os.path.join(carpeta, nombre)] = (tamano, mtime, resumen)
+        return completa
+
+    def olvidar(self, carpeta):
+        prefijo = carpeta + os.sep
+        with self.lock:
+            db = self.abrir()
+            with db:
+                db.execute("DELETE FROM carpetas WHERE ruta = ? OR substr(ruta, 1, ?) = ?",
+                           (carpeta, len(prefijo), prefijo))
+                db.execute("DELETE FROM archivos WHERE carpeta = ? OR substr(carpeta, 1, ?) = ?",
+                           (carpeta, len(prefijo), prefijo))
+            for ruta in [r for r in self.publicados if r.startswith(prefijo)]:
+                del self.publicados[ruta]
+
+    def metadatos(self, ruta):
+        """(tamaño, mtime_ns, sha1) de un archivo publicable, o None si no se puede asegurar que siga así.
+
+        Solo se contesta mientras watchdog mantiene el catálogo al día; si
+        no, un archivo reescrito sin tocar su carpeta pasaría inadvertido y
+        quien pregunta tiene que hacer su propio stat.
+        """
+        if not self.al_dia:
+            return None
+        return self.publicados.get(ruta)
+
+    def archivos(self, carpeta):
+        """Lista ordenada de (nombre, tamaño, mtime_ns, sha1) de carpeta, o None si no está catalogada."""
+        with self.lock:
+            db = self.abrir()
+            if db.execute("SELECT 1 FROM carpetas WHERE ruta = ?", (carpeta,)).fetchone() is None:
+                return None
+            return db.execute("SELECT nombre, tamano, mtime_ns, sha1 FROM archivos "
+                              "WHERE carpeta = ? ORDER BY nombre", (carpeta,)).fetchall()
+
+class _EventosIndice:
+    """Manejador de eventos de watchdog: relee la carpeta donde algo se creó, borró, movió o reescribió."""
+    def __init__(self, indice):
+        self.indice = indice
+
+    def dispatch(self, evento):
+        if evento.event_type == "modified" and not evento.is_directory:
+            # Reescribir un archivo no cambia el mtime de su carpeta, pero sí su tamaño y su sha1
+            self.indice.refrescar(os.path.dirname(os.fsdecode(evento.src_path)))
+            return
+        if evento.event_type not in ("created", "deleted", "moved"):
+            return
+        for ruta in (evento.src_path, getattr(evento, "dest_path", "")):
+            if ruta:
+                self.indice.refrescar(os.path.dirname(os.fsdecode(ruta)))
+
+class IndicePublicados:
+    """Índice en memoria de los archivos publicables de todos los usuarios.
+
+    Guarda, por carpeta, su mtime, los archivos publicables y las subcarpetas
+    que se recorren. Se construye una vez recorriendo base y después solo se
+    vuelve a leer la carpeta que cambia: la que toca el editor, la que avisa
+    watchdog o, si no está instalado, la que cambia de mtime en la revisión
+    periódica (crear, borrar o renombrar algo cambia el mtime de su carpeta).
+    """
+    def __init__(self, base, sitio, publicable, listados, catalogo=None):
+        self.base = base
+        self.sitio = sitio            # subcarpeta de cada usuario que se publica ("" = toda)
+        self.publicable = publicable
+        self.listados = listados      # ListadoCarpetas con el que se leen las carpetas
+        self.catalogo = catalogo
+        self.carpetas = {}            # carpeta -> (mtime_ns, archivos, subcarpetas)
+        self.version = 0
+        self.listado = None           # (version, resultado, usuarios) de la última instantánea
+        self.consultas = OrderedDict()  # páginas de consultar() ya calculadas (LRU)
+        self.pid = None
+        self.vigilado = False         # con watchdog no hay revisiones periódicas (ver releer_despues)
+        self.sin_resumen = set()      # carpetas que se volverán a leer cuando sus mtimes sean fiables
+        self.listo = threading.Event()  # se activa cuando el índice de este proceso está completo
+        self.lock = threading.Lock()
+        os.register_at_fork(after_in_child=self.tras_fork)
+
+    def tras_fork(self):
+        self.vigilado = False
+        self.sin_resumen = set()
+        self.listo = threading.Event()
+        self.lock = threading.Lock()
+
+    def sitio_de(self, carpeta):
+        """(usuario, partes de la ruta dentro de su sitio) o None si carpeta no se publica."""
+        partes = os.path.relpath(carpeta, self.base).split(os.sep)
+        if partes[0] in (".", ".."):
+            return None
+        if self.sitio:
+            if len(partes) < 2 or partes[1] != self.sitio:
+                return None
+            return partes[0], partes[2:]
+        return partes[0], partes[1:]
+
+    def seguir(self, carpeta, nombre):
+        if self.sitio and os.path.dirname(carpeta) == self.base:
+            return nombre == self.sitio
+        return True
+
+    def escanear(self, carpeta):
+        """Vuelve a leer una carpeta y devuelve sus subcarpetas nuevas."""
+        try:
+            mtime, nombres_carpetas, nombres_archivos = self.listados.listar(carpeta, enlaces=False)
+        except OSError:
+            self.olvidar(carpeta)
+            return []
+        # Con un mtime demasiado reciente se guarda None: la próxima revisión la volverá a leer
+        mtime = mtime_fiable(mtime)
+        subcarpetas = {n for n in nombres_carpetas if self.seguir(carpeta, n)}
+        archivos = set()
+        if self.sitio_de(carpeta) is not None:
+            archivos = {n for n in nombres_archivos if self.publicable(n)}
+        if self.catalogo is not None:
+            padre = os.path.dirname(carpeta) if carpeta != self.base else None
+            datos = {}
+            for nombre in nombres_archivos:
+                try:
+                    st = os.stat(os.path.join(carpeta, nombre))
+                except OSError:
+                    continue
+                datos[nombre] = (st.st_size, st.st_mtime_ns)
+            if not self.catalogo.actualizar_carpeta(carpeta, padre, mtime, datos, archivos):
+                # Algún archivo quedó sin sha1: con None la próxima revisión vuelve a leerla
+                mtime = None
+                if self.vigilado:
+                    self.releer_despues(carpeta)
+        with self.lock:
+            anterior = self.carpetas.get(carpeta, (None, frozenset(), frozenset()))
+            self.carpetas[carpeta] = (mtime, frozenset(archivos), frozenset(subcarpetas))
+            if anterior[1] != archivos or anterior[2] != subcarpetas:
+                self.version += 1
+        for nombre in anterior[2] - subcarpetas:
+            self.olvidar(os.path.join(carpeta, nombre))
+        return [os.path.join(carpeta, nombre) for nombre in subcarpetas - anterior[2]]
+
+    def releer_despues(self, carpeta):
+        """Con watchdog no hay revisiones periódicas: la carpeta se relee cuando sus mtimes ya valgan."""
+        with self.lock:
+            if carpeta in self.sin_resumen:
+                return
+            self.sin_resumen.add(carpeta)
+        temporizador = threading.Timer(LISTADO_MARGEN + 0.1, self.releer, (carpeta,))
+        temporizador.daemon = True
+        temporizador.start()
+
+    def releer(self, carpeta):
+        with self.lock:
+            self.sin_resumen.discard(carpeta)
+        try:
+            self.refrescar(carpeta)
+        except Exception:
+            traceback.print_exc()
+
+    def recorrer(self, carpeta):
+        pendientes = [carpeta]
+        while pendientes:
+            pendientes.extend(self.escanear(pendientes.pop()))
+
+    def olvidar(self, carpeta):
+        prefijo = carpeta + os.sep
+        with self.lock:
+            viejas = [c for c in self.carpetas if c == carpeta or c.startswith(prefijo)]
+            for c in viejas:
+                del self.carpetas[c]
+            if viejas:
+                self.version += 1
+        if viejas and self.catalogo is not None:
+            self.catalogo.olvidar(carpeta)
+
+    def refrescar(self, carpeta):
+        """Avisa de que algo cambió dentro de carpeta (la relee y recorre lo nuevo)."""
+        carpeta = os.path.abspath(carpeta)
+        with self.lock:
+            # Si es nueva, se relee la primera carpeta conocida por encima
+            while carpeta not in self.carpetas and carpeta.startswith(self.base + os.sep):
+                carpeta = os.path.dirname(carpeta)
+            conocida = carpeta in self.carpetas
+        if conocida:
+            for nueva in self.escanear(carpeta):
+                self.recorrer(nueva)
+
+    def revisar(self):
+        """Relee las carpetas cuyo mtime ha cambiado desde la última vez."""
+        with self.lock:
+            conocidas = [(c, datos[0]) for c, datos in self.carpetas.items()]
+        for carpeta, mtime in conocidas:
+            try:
+                cambiada = os.stat(carpeta).st_mtime_ns != mtime
+            except OSError:
+                cambiada = True
+            if cambiada:
+                self.refrescar(carpeta)
+
+    def cargar_catalogo(self):
+        """Carpetas guardadas en el catálogo, con lo publicable recalculado con las reglas de este índice."""
+        carpetas = {}
+        for carpeta, (mtime, archivos, subcarpetas) in self.catalogo.cargar().items():
+            if self.sitio_de(carpeta) is None:
+                archivos = frozenset()
+            carpetas[carpeta] = (mtime, frozenset(a for a in archivos if self.publicable(a)), subcarpetas)
+        return carpetas
+
+    def iniciar(self):
+        """Construye el índice y arranca su vigilancia en este proceso (una vez por proceso).
+
+        Se lanza al arrancar el servidor; si una petición llega antes de que
+        termine, espera a que el índice esté completo.
+        """
+        if self.pid != os.getpid():
+            with self.lock:
+                construir = self.pid != os.getpid()
+                self.pid = os.getpid()
+            if construir:
+                self.vigilado = Observer is not None
+                try:
+                    if not self.carpetas and self.catalogo is not None:
+                        carpetas = self.cargar_catalogo()
+                        with self.lock:
+                            self.carpetas = carpetas
+                    # Cargado del catálogo o heredado de un fork: puede haber cambios desde entonces
+                    if self.carpetas:
+                        self.revisar()
+                    else:
+                        self.recorrer(self.base)
+                finally:
+                    self.listo.set()
+                if Observer is not None:
+                    observador = Observer()
+                    observador.daemon = True
+                    observador.schedule(_EventosIndice(self), self.base, recursive=True)
+                    observador.start()
+                    if self.catalogo is not None:
+                        self.catalogo.al_dia = True
+                else:
+                    threading.Thread(target=self.vigilar, daemon=True).start()
+        self.listo.wait()
+
+    def vigilar(self):
+        while True:
+            time.sleep(INDICE_INTERVALO)
+            try:
+                self.revisar()
+            except Exception:
+                traceback.print_exc()
+
+    def instantanea(self):
+        """(version, usuario -> archivos, usuarios ordenados) del estado actual del índice."""
+        self.iniciar()
+        with self.lock:
+            if self.listado is not None and self.listado[0] == self.version:
+                return self.listado
+            version = self.version
+            carpetas = list(self.carpetas.items())
+        resultado = {}
+        for carpeta, (_, archivos, _) in carpetas:
+            sitio = self.sitio_de(carpeta)
+            if not archivos or sitio is None:
+                continue
+            usuario, partes = sitio
+            resultado.setdefault(usuario, []).extend("/".join(partes + [a]) for a in archivos)
+        for archivos in resultado.values():
+            archivos.sort()
+        listado = (version, resultado, sorted(resultado))
+        with self.lock:
+            self.listado = listado
+        return listado
+
+    def listar(self):
+        """Dict usuario -> lista ordenada de archivos publicables (rutas con '/')."""
+        return self.instantanea()[1]
+
+    def consultar(self, prefijo="", texto="", pagina=1, por_pagina=USUARIOS_POR_PAGINA):
+        """Una página de /servidores: (lista de (usuario, archivos), total de usuarios).
+
+        prefijo filtra por inicio del nombre de usuario (bisect sobre la lista
+        ordenada); texto, sin distinguir mayúsculas, deja los usuarios cuyo
+        nombre lo contiene con todos sus archivos y, del resto, los archivos
+        cuya ruta lo contiene. El orden es siempre usuario y ruta. Cada página
+        calculada se guarda hasta que cambia el índice.
+        """
+        version, resultado, usuarios = self.instantanea()
+        clave = (version, prefijo, texto, pagina, por_pagina)
+        with self.lock:
+            guardada = self.consultas.get(clave)
+            if guardada is not None:
+                self.consultas.move_to_end(clave)
+                return guardada
+        inicio = bisect.bisect_left(usuarios, prefijo)
+        fin = bisect.bisect_left(usuarios, prefijo + "\U0010ffff") if prefijo else len(usuarios)
+        if texto:
+            texto_min = texto.lower()
+            filas = []
+            for usuario in usuarios[inicio:fin]:
+                archivos = resultado[usuario]
+                if texto_min not in usuario.lower():
+                    archivos = [a for a in archivos if texto_min in a.lower()]
+                if archivos:
+                    filas.append((usuario, archivos))
+        else:
+            filas = [(usuario, resultado[usuario]) for usuario in usuarios[inicio:fin]]
+        respuesta = (filas[(pagina - 1) * por_pagina:pagina * por_pagina], len(filas))
+        with self.lock:
+            self.consultas[clave] = respuesta
+            while len(self.consultas) > CONSULTAS_MAX:
+                self.consultas.popitem(last=False)
+        return respuesta
+
+class CacheRevalidada:
+    """Respuestas ya generadas con TTL y stale-while-revalidate.
+
+    Una entrada caduca a los ttl segundos o cuando cambia version() (la del
+    índice de publicados, que sube en cuanto se escribe o borra un archivo).
+    Caducada por TTL se sigue sirviendo mientras un único hilo la reconstruye
+    en segundo plano. Con otra versión es un fallo: como sin copia, las
+    peticiones que llegan a la vez esperan a una sola construcción.
+    """
+    def __init__(self, ttl, max_entradas, version):
+        self.ttl = ttl
+        self.max_entradas = max_entradas
+        self.version = version
+        self.entradas = OrderedDict()  # clave -> (version, creada, valor)
+        self.construyendo = {}         # clave -> Event que se activa al terminar
+        self.aciertos = 0
+        self.obsoletas = 0
+        self.construcciones = 0
+        self.lock = threading.Lock()
+        os.register_at_fork(after_in_child=self.tras_fork)
+
+    def tras_fork(self):
+        self.construyendo = {}
+        self.lock = threading.Lock()
+
+    def obtener(self, clave, construir):
+        while True:
+            version = self.version()
+            with self.lock:
+                entrada = self.entradas.get(clave)
+                if entrada is not None and entrada[0] == version:
+                    self.entradas.move_to_end(clave)
+                    if time.monotonic() - entrada[1] < self.ttl:
+                        self.aciertos += 1
+                        return entrada[2]
+                    self.obsoletas += 1
+                    if clave not in self.construyendo:
+                        self.construyendo[clave] = threading.Event()
+                        threading.Thread(target=self.reconstruir_fondo, args=(clave, construir), daemon=True).start()
+                    return entrada[2]
+                evento = self.construyendo.get(clave)
+                if evento is None:
+                    self.construyendo[clave] = threading.Event()
+            if evento is None:
+                return self.reconstruir(clave, construir)
+            # La construcción esperada pudo fallar o ser de una versión anterior: se vuelve a mirar
+            evento.wait()
+
+    def reconstruir(self, clave, construir):
+        # Llamar después de apuntar clave en self.construyendo
+        try:
+            version = self.version()
+            valor = construir()
+            with self.lock:
+                self.construcciones += 1
+                self.entradas[clave] = (version, time.monotonic(), valor)
+                self.entradas.move_to_end(clave)
+                while len(self.entradas) > self.max_entradas:
+                    self.entradas.popitem(last=False)
+            return valor
+        finally:
+            with self.lock:
+                evento = self.construyendo.pop(clave, None)
+            if evento is not None:
+                evento.set()
+
+    def reconstruir_fondo(self, clave, construir):
+        try:
+            self.reconstruir(clave, construir)
+        except Exception:
+            traceback.print_exc()
+
+    def estadisticas(self):
+        with self.lock:
+            return {"entradas": len(self.entradas), "aciertos": self.aciertos,
+                    "obsoletas": self.obsoletas, "construcciones": self.construcciones}
+
+class Comprimidos:
+    """Variantes comprimidas (gzip/brotli) de los archivos de raiz, guardadas en carpeta.
+
+    Cada una lleva el mtime de su original; si ya no coincide, se rehace.
+    """
+    def __init__(self, raiz, carpeta):
+        self.raiz = raiz
+        self.carpeta = carpeta
+
+    def ruta(self, ruta, codificacion):
+        """Sidecar de ruta en self.carpeta; ValueError si alguna de las dos se sale de su carpeta."""
+        ruta = os.path.realpath(ruta)
+        if not dentro_de(ruta, self.raiz):
+            raise ValueError("Solo se comprimen archivos de la raíz.")
+        rel = os.path.relpath(ruta, os.path.realpath(self.raiz))
+        destino = os.path.join(os.path.realpath(self.carpeta), rel + (".br" if codificacion == "br" else ".gz"))
+        if not dentro_de(destino, self.carpeta):
+            raise ValueError("Intento de acceso fuera del directorio permitido.")
+        return destino
+
+    def generar(self, ruta, codificacion):
+        """Crea (o rehace) el sidecar de ruta con el mismo mtime que el original.
+
+        Devuelve su ruta, o None si el original cambió mientras se comprimía.
+        """
+        destino = self.ruta(ruta, codificacion)
+        os.makedirs(os.path.dirname(destino), exist_ok=True)
+        tmp = f"{destino}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(ruta, "rb") as origen:
+            st = os.fstat(origen.fileno())
+            with open(tmp, "wb") as salida:
+                if codificacion == "br":
+                    compresor = brotli.Compressor()
+                    for bloque in iter(lambda: origen.read(TAM_BLOQUE), b""):
+                        salida.write(compresor.process(bloque))
+                    salida.write(compresor.finish())
+                else:
+                    with gzip.GzipFile(filename="", fileobj=salida, mode="wb", mtime=0) as gz:
+                        shutil.copyfileobj(origen, gz, TAM_BLOQUE)
+        if os.stat(ruta).st_mtime_ns != st.st_mtime_ns:
+            os.remove(tmp)
+            return None
+        os.utime(tmp, ns=(st.st_atime_ns, st.st_mtime_ns))
+        os.replace(tmp, destino)
+        return destino
+
+    def obtener(self, ruta, mtime_ns, codificacion):
+        """Sidecar vigente para la versión de ruta con ese mtime; se genera la primera vez que se pide."""
+        try:
+            destino = self.ruta(ruta, codificacion)
+            if os.stat(destino).st_mtime_ns == mtime_ns:
+                return destino
+        except ValueError:
+            return None
+        except OSError:
+            pass
+        try:
+            destino = self.generar(ruta, codificacion)
+        except OSError:
+            return None
+        if destino and os.stat(destino).st_mtime_ns == mtime_ns:
+            return destino
+        return None
+
+    def precomprimir(self, ruta):
+        """Genera ya las variantes comprimidas para que el primer visitante no espere."""
+        try:
+            if not comprimible(ruta, os.path.getsize(ruta)):
+                return
+            for codificacion in codificaciones_disponibles():
+                self.generar(ruta, codificacion)
+        except (OSError, ValueError):
+            pass
+
+    def borrar(self, ruta):
+        for codificacion in ("br", "gzip"):
+            try:
+                os.remove(self.ruta(ruta, codificacion))
+            except (OSError, ValueError):
+                pass
+
+class CacheBytes:
+    """Caché LRU de respuestas ya codificadas (cuerpo + cabeceras) con presupuesto en bytes.
+
+    Cada entrada lleva la firma (inodo, tamaño, mtime) del archivo del que salió;
+    si al pedirla no coincide con la actual cuenta como fallo, así un archivo
+    editado nunca se sirve viejo. Opcionalmente caduca a los ttl segundos.
+    Es segura entre hilos.
+    """
+    def __init__(self, max_bytes, max_entrada):
+        self.max_bytes = max_bytes
+        self.max_entrada = max_entrada
+        self.entradas = OrderedDict()
+        self.bytes = 0
+        self.aciertos = 0
+        self.fallos = 0
+        self.lock = threading.Lock()
+        os.register_at_fork(after_in_child=self.tras_fork)
+
+    def tras_fork(self):
+        self.lock = threading.Lock()
+
+    def obtener(self, clave, firma):
+        with self.lock:
+            entrada = self.entradas.get(clave)
+            if entrada is not None and entrada[3] is not None and time.monotonic() >= entrada[3]:
+                del self.entradas[clave]
+                self.bytes -= len(entrada[1])
+                entrada = None
+            if entrada is None or entrada[0] != firma:
+                self.fallos += 1
+                return None
+            self.entradas.move_to_end(clave)
+            self.aciertos += 1
+            return entrada[1], entrada[2]
+
+    def guardar(self, clave, firma, cuerpo, cabeceras, ttl=None):
+        if len(cuerpo) > self.max_entrada:
+            return
+        with self.lock:
+            anterior = self.entradas.pop(clave, None)
+            if anterior is not None:
+                self.bytes -= len(anterior[1])
+            caduca = time.monotonic() + ttl if ttl else None
+            self.entradas[clave] = (firma, cuerpo, cabeceras, caduca)
+            self.bytes += len(cuerpo)
+            while self.bytes > self.max_bytes:
+                _, (_, viejo, _, _) = self.entradas.popitem(last=False)
+                self.bytes -= len(viejo)
+
+    def estadisticas(self):
+        with self.lock:
+            return {"entradas": len(self.entradas), "bytes": self.bytes,
+                    "aciertos": self.aciertos, "fallos": self.fallos}
+
+def ruta_modulo(carpeta, ruta, st):
+    """Módulo Python compilado, dentro de carpeta, para esta versión exacta del .mako.
+
+    El nombre incluye mtime y tamaño de la fuente: si cambia, se usa otro
+    módulo y nunca se carga uno desfasado. Mako lo escribe en un temporal y
+    lo renombra, así que varios procesos pueden compilarlo a la vez.
+    """
+    clave = hashlib.sha1(os.path.abspath(ruta).encode("utf-8")).hexdigest()
+    return os.path.join(carpeta, clave[:2], f"{clave}_{st.st_mtime_ns}_{st.st_size}.py")
+
+def limpiar_modulos_viejos(modulo):
+    """Borra las versiones anteriores compiladas del mismo .mako."""
+    carpeta, nombre = os.path.split(modulo)
+    prefijo = nombre.split("_", 1)[0] + "_"
+    try:
+        for otro in os.listdir(carpeta):
+            if otro.startswith(prefijo) and otro != nombre and otro.endswith(".py"):
+                os.remove(os.path.join(carpeta, otro))
+    except OSError:
+        pass
+
+class CacheTemplates:
+    """Templates de Mako ya compilados, por ruta, invalidados por mtime y tamaño.
+
+    compilar(ruta, st) construye cada template. Guarda como mucho max_entradas
+    (LRU). Cada ruta tiene su propio lock de compilación: si llegan a la vez
+    varias peticiones a un template nuevo o modificado, solo una lo compila y
+    las demás reutilizan el resultado.
+    """
+    def __init__(self, max_entradas, compilar):
+        self.max_entradas = max_entradas
+        self.compilar = compilar
+        self.entradas = OrderedDict()
+        self.compilando = {}
+        self.aciertos = 0
+        self.compilaciones = 0
+        self.lock = threading.Lock()
+
+    def buscar(self, ruta, firma):
+        # Llamar con self.lock tomado
+        entrada = self.entradas.get(ruta)
+        if entrada is None or entrada[0] != firma:
+            return None
+        self.entradas.move_to_end(ruta)
+        self.aciertos += 1
+        return entrada[1]
+
+    def obtener(self, ruta):
+        st = os.stat(ruta)
+        firma = (st.st_mtime_ns, st.st_size)
+        with self.lock:
+            template = self.buscar(ruta, firma)
+            if template is not None:
+                return template
+            candado = self.compilando.setdefault(ruta, threading.Lock())
+        with candado:
+            with self.lock:
+                template = self.buscar(ruta, firma)
+                if template is not None:
+                    return template
+            try:
+                template = self.compilar(ruta, st)
+            except BaseException:
+                with self.lock:
+                    self.compilando.pop(ruta, None)
+                raise
+            with self.lock:
+                self.compilaciones += 1
+                self.entradas[ruta] = (firma, template)
+                self.entradas.move_to_end(ruta)
+                while len(self.entradas) > self.max_entradas:
+                    self.entradas.popitem(last=False)
+                # Ya guardado: quien llegue ahora lo encuentra sin crear otro candado;
+                # los que esperan en este lo ven al soltarlo
+                self.compilando.pop(ruta, None)
+        return template
+
+    def estadisticas(self):
+        with self.lock:
+            return {"entradas": len(self.entradas), "aciertos": self.aciertos,
+                    "compilaciones": self.compilaciones}
+
+class RenderError(Exception):
+    """El template falló dentro del proceso de render."""
+
+class RenderTimeout(Exception):
+    """El render superó su tiempo de reloj o de CPU."""
+
+class RenderOcupado(Exception):
+    """Hay demasiados renders esperando; se contesta 503."""
+
+def alarma_render(signum, frame):
+    if signum == signal.SIGALRM:
+        raise RenderTimeout("tiempo de render agotado")
+    raise RenderTimeout("CPU de render agotada")
+
+def preparar_proceso_render(memoria_mb):
+    """Límites y señales de un proceso de render recién creado."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if resource is not None and memoria_mb:
+        limite = memoria_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limite, limite))
+    if hasattr(signal, "SIGXCPU"):
+        signal.signal(signal.SIGXCPU, alarma_render)
+    if hasattr(signal, "SIGALRM"):
+        signal.signal(signal.SIGALRM, alarma_render)
+
+def render_en_proceso(plantillas, ruta, contexto, tiempo_max, cpu_max):
+    """Se ejecuta en un proceso del pool con su CacheTemplates; devuelve (estado, html o mensaje)."""
+    if resource is not None and cpu_max:
+        uso = resource.getrusage(resource.RUSAGE_SELF)
+        duro = resource.getrlimit(resource.RLIMIT_CPU)[1]
+        resource.setrlimit(resource.RLIMIT_CPU, (int(uso.ru_utime + uso.ru_stime + cpu_max) + 1, duro))
+    if hasattr(signal, "setitimer"):
+        signal.setitimer(signal.ITIMER_REAL, tiempo_max)
+    try:
+        return "ok", str(plantillas.obtener(ruta).render(**contexto))
+    except RenderTimeout as e:
+        return "tiempo", str(e)
+    except MemoryError:
+        return "memoria", "memoria de render agotada"
+    except Exception as e:
+        return "error", str(e)
+    finally:
+        if hasattr(signal, "setitimer"):
+            signal.setitimer(signal.ITIMER_REAL, 0)
+        if resource is not None and cpu_max:
+            resource.setrlimit(resource.RLIMIT_CPU, (duro, duro))
+
+def proceso_render(conexion, iniciar, memoria_mb):
+    """Bucle de un proceso de render: recibe (ruta, contexto, tiempo_max, cpu_max) y contesta."""
+    preparar_proceso_render(memoria_mb)
+    plantillas = iniciar()
+    padre = os.getppid()
+    while True:
+        if not conexion.poll(1):
+            if os.getppid() != padre:
+                return  # el semillero ya no existe
+            continue
+        try:
+            tarea = conexion.recv()
+        except EOFError:
+            return
+        if tarea is None:
+            return
+        conexion.send(render_en_proceso(plantillas, *tarea))
+
+ORDEN_SEMILLERO = struct.Struct("=ci")  # (b"L", 0): lanzar un proceso; (b"K", pid): matarlo
+
+def matar_hijo(pid):
+    os.kill(pid, signal.SIGKILL)
+    os.waitpid(pid, 0)
+
+def semillero_render(control, iniciar, memoria_mb):
+    """Crea y mata los procesos de render de un PoolRender según las órdenes de control.
+
+    Cada proceso nuevo se manda al servidor como (pid, descriptor de su
+    conexión). Termina, llevándose a sus procesos, cuando el servidor
+    cierra control.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    hijos = set()
+    try:
+        while True:
+            orden = control.recv(ORDEN_SEMILLERO.size, socket.MSG_WAITALL)
+            if len(orden) < ORDEN_SEMILLERO.size:
+                return
+            accion, pid = ORDEN_SEMILLERO.unpack(orden)
+            # Hasta recogerlo, un hijo muerto conserva su pid: matarlo no alcanza a otro proceso
+            for muerto in [p for p in hijos if os.waitpid(p, os.WNOHANG)[0]]:
+                hijos.discard(muerto)
+            if accion == b"K":
+                if pid in hijos:
+                    hijos.discard(pid)
+                    matar_hijo(pid)
+                continue
+            propio, ajeno = socket.socketpair()
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    control.close()
+                    ajeno.close()
+                    proceso_render(Connection(propio.detach()), iniciar, memoria_mb)
+                except Exception:
+                    traceback.print_exc()
+                finally:
+                    os._exit(0)
+            propio.close()
+            hijos.add(pid)
+            socket.send_fds(control, [ORDEN_SEMILLERO.pack(b"L", pid)], [ajeno.fileno()])
+            ajeno.close()
+    finally:
+        for pid in hijos:
+            matar_hijo(pid)
+
+class PoolRender:
+    """Renderiza templates en procesos aparte, con límites de reloj, CPU y memoria.
+
+    Un render pesado ya no retiene el GIL de los hilos que sirven peticiones.
+    Cada petición espera a que quede libre un proceso (503 si ya esperan
+    RENDER_PENDIENTES_POR_PROCESO por proceso) y el tiempo máximo cuenta
+    desde que el proceso recibe el render, no desde que se encola. Si un
+    proceso no responde ni a su propia alarma se mata solo ese y se lanza
+    otro en su lugar; también se recicla tras tareas_por_proceso renders.
+    iniciar() se ejecuta en cada proceso nuevo y devuelve la CacheTemplates
+    con la que renderiza.
+
+    Los procesos no se crean con fork desde el servidor, que ya tiene hilos
+    y podría dejar en el hijo un lock tomado para siempre, sino desde un
+    semillero (semillero_render) que arrancar() crea mientras el proceso
+    tiene un solo hilo. Los contextos spawn y forkserver no sirven: vuelven
+    a importar el script, y v0.0.115 pregunta su configuración al cargarse.
+    """
+    def __init__(self, procesos, iniciar, tiempo_max=RENDER_TIEMPO_MAX, cpu_max=RENDER_CPU_MAX,
+                 memoria_mb=RENDER_MEMORIA_MB, tareas_por_proceso=RENDER_TAREAS_POR_PROCESO):
+        self.procesos = procesos
+        self.iniciar = iniciar
+        self.tiempo_max = tiempo_max
+        self.cpu_max = cpu_max
+        self.memoria_mb = memoria_mb
+        self.tareas_por_proceso = tareas_por_proceso
+        self.pendientes = threading.BoundedSemaphore(procesos * RENDER_PENDIENTES_POR_PROCESO)
+        self.libres = None    # Queue de [pid, conexión, renders hechos]
+        self.control = None   # socket de órdenes al semillero
+        self.lock = threading.Lock()
+        self.lock_control = threading.Lock()
+
+    def arrancar(self):
+        with self.lock:
+            if self.libres is None:
+                self.control, extremo = socket.socketpair()
+                if os.fork() == 0:
+                    try:
+                        self.control.close()
+                        semillero_render(extremo, self.iniciar, self.memoria_mb)
+                    except Exception:
+                        traceback.print_exc()
+                    finally:
+                        os._exit(0)
+                extremo.close()
+                self.libres = queue.Queue()
+                for _ in range(self.procesos):
+                    self.libres.put(self.lanzar())
+            return self.libres
+
+    def lanzar(self):
+        with self.lock_control:
+            self.control.sendall(ORDEN_SEMILLERO.pack(b"L", 0))
+            orden, fds, _, _ = socket.recv_fds(self.control, ORDEN_SEMILLERO.size, 1)
+        if len(orden) < ORDEN_SEMILLERO.size or not fds:
+            raise RenderError("el semillero de render no responde")
+        return [ORDEN_SEMILLERO.unpack(orden)[1], Connection(fds[0]), 0]
+
+    def retirar(self, trabajador):
+        pid, conexion, _ = trabajador
+        conexion.close()
+        with self.lock_control:
+            self.control.sendall(ORDEN_SEMILLERO.pack(b"K", pid))
+
+    def render(self, ruta, contexto):
+        if not self.pendientes.acquire(blocking=False):
+            raise RenderOcupado("demasiados renders en espera")
+        try:
+            libres = self.arrancar()
+            try:
+                trabajador = libres.get(timeout=self.tiempo_max)
+            except queue.Empty:
+                raise RenderOcupado("ningún proceso de render quedó libre a tiempo")
+            try:
+                conexion = trabajador[1]
+                conexion.send((ruta, contexto, self.tiempo_max, self.cpu_max))
+                if not conexion.poll(self.tiempo_max + 2):
+                    self.retirar(trabajador)
+                    trabajador = self.lanzar()
+                    raise RenderTimeout("el proceso de render no respondió")
+                estado, valor = conexion.recv()
+            except (OSError, EOFError):
+                # El proceso murió (p. ej. al pasarse del límite de memoria)
+                self.retirar(trabajador)
+                trabajador = self.lanzar()
+                raise RenderError("el proceso de render terminó de forma inesperada")
+            else:
+                trabajador[2] += 1
+                if trabajador[2] >= self.tareas_por_proceso:
+                    self.retirar(trabajador)
+                    trabajador = self.lanzar()
+            finally:
+                libres.put(trabajador)
+        finally:
+            self.pendientes.release()
+        if estado == "ok":
+            return valor
+        if estado == "tiempo":
+            raise RenderTimeout(valor)
+        if estado == "memoria":
+            raise RenderOcupado(valor)
+        raise RenderError(valor)
+
+class ManejadorBase(http.server.SimpleHTTPRequestHandler):
+    """Base de los manejadores: HTTP/1.1 con conexiones persistentes y respuestas comunes."""
+    protocol_version = "HTTP/1.1"
+    timeout = TIEMPO_INACTIVO
+    cache_paginas = None         # CacheBytes de enviar_archivo
+    comprimidos = None           # Comprimidos de enviar_archivo
+    catalogo = None              # CatalogoArchivos del que enviar_archivo saca los metadatos
+
+    def handle_one_request(self):
+        self.peticiones = getattr(self, "peticiones", 0) + 1
+        super().handle_one_request()
+
+    def send_response(self, code, message=None):
+        """Añade las cabeceras de conexión persistente (HTTP/1.1) a cada respuesta."""
+        super().send_response(code, message)
+        if self.peticiones >= MAX_PETICIONES_CONEXION:
+            self.send_header("Connection", "close")
+        elif not self.close_connection:
+            restantes = MAX_PETICIONES_CONEXION - self.peticiones
+            if self.request_version == "HTTP/1.0":
+                self.send_header("Connection", "keep-alive")
+            self.send_header("Keep-Alive", f"timeout={TIEMPO_INACTIVO}, max={restantes}")
+
+    def cliente_local(self):
+        """True si la petición viene de esta misma máquina (loopback, también IPv4 dentro de IPv6)."""
+        try:
+            ip = ipaddress.ip_address(self.client_address[0])
+        except (ValueError, IndexError, TypeError):
+            return False
+        if getattr(ip, "ipv4_mapped", None) is not None:
+            ip = ip.ipv4_mapped
+        return ip.is_loopback
+
+    def do_POST(self):
+        # SimpleHTTPRequestHandler no acepta POST: lo mismo que contesta
+        # BaseHTTPRequestHandler a un método sin do_*, para quien llame a super()
+        self.send_error(501, f"Unsupported method ({self.command!r})")
+
+    def enviar_html(self, html, code=200):
+        cuerpo = html.encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(cuerpo)))
+        self.end_headers()
+        self.wfile.write(cuerpo)
+
+    def etag_coincide(self, etag):
+        """True si If-None-Match incluye etag (o es '*')."""
+        etiquetas = [e.strip().removeprefix("W/") for e in self.headers.get("If-None-Match", "").split(",")]
+        return "*" in etiquetas or etag in etiquetas
+
+    def no_modificado(self, etag, mtime):
+        """True si el cliente ya tiene esta versión (If-None-Match / If-Modified-Since)."""
+        if self.headers.get("If-None-Match"):
+            return self.etag_coincide(etag)
+        if_modified_since = self.headers.get("If-Modified-Since")
+        if if_modified_since:
+            try:
+                fecha = email.utils.parsedate_to_datetime(if_modified_since)
+            except (TypeError, ValueError):
+                return False
+            return fecha.tzinfo is not None and int(mtime) <= fecha.timestamp()
+        return False
+
+    def cabeceras_validacion(self, ruta, etag, ultima_mod, variable):
+        cabeceras = {"ETag": etag, "Last-Modified": ultima_mod, "Cache-Control": politica_cache(ruta)}
+        if variable:
+            cabeceras["Vary"] = "Accept-Encoding"
+        return cabeceras
+
+    def enviar_cabeceras(self, code, cabeceras):
+        self.send_response(code)
+        for nombre, valor in cabeceras.items():
+            self.send_header(nombre, valor)
+        self.end_headers()
+
+    def copiar_archivo(self, f, inicio, longitud):
+        """Envía longitud bytes de f desde inicio sin cargarlos en memoria.
+
+        Con un socket real usa sendfile (copia en el kernel); si no hay
+        sendfile, o el wfile no es un socket, copia por bloques de TAM_BLOQUE.
+        """
+        if hasattr(self.wfile, "adjuntar"):
+            # Motor async de apacheFTP: lo envía el bucle de eventos cuando el cliente vaya leyendo
+            self.wfile.adjuntar(f, inicio, longitud)
+            return
+        conexion = getattr(self, "connection", None)
+        if hasattr(os, "sendfile") and isinstance(conexion, socket.socket):
+            self.wfile.flush()
+            conexion.sendfile(f, inicio, longitud)
+            return
+        f.seek(inicio)
+        restantes = longitud
+        while restantes > 0:
+            bloque = f.read(min(TAM_BLOQUE, restantes))
+            if not bloque:
+                break
+            self.wfile.write(bloque)
+            restantes -= len(bloque)
+
+    def enviar_archivo(self, ruta, tipo):
+        """Envía un archivo publicado: 304, copia en memoria (cache_paginas) o desde disco.
+
+        Tamaño, mtime y ETag (su sha1) salen del catálogo si lo tiene al día;
+        si no, de un stat, con la ETag de calcular_etag.
+        """
+        meta = self.catalogo.metadatos(ruta) if self.catalogo is not None else None
+        if meta is not None:
+            tamano, mtime_ns, resumen = meta
+            etag = f'"{resumen}"'
+            firma = meta
+        else:
+            st = os.stat(ruta)
+            tamano, mtime_ns = st.st_size, st.st_mtime_ns
+            etag = calcular_etag(st)
+            firma = (st.st_ino, st.st_size, st.st_mtime_ns)
+        mtime = mtime_ns / 1e9
+        variable = comprimible(ruta, tamano)
+        codificacion = elegir_codificacion(self.headers.get("Accept-Encoding", "")) if variable else None
+        clave = (ruta, codificacion)
+        guardada = self.cache_paginas.obtener(clave, firma)
+        if guardada is not None:
+            cuerpo, cabeceras = guardada
+            if self.no_modificado(cabeceras["ETag"], mtime):
+                self.enviar_cabeceras(304, {k: v for k, v in cabeceras.items() if not k.startswith("Content-")})
+                return
+            self.enviar_cabeceras(200, cabeceras)
+            self.wfile.write(cuerpo)
+            return
+        ultima_mod = self.date_time_string(int(mtime))
+        comprimido = self.comprimidos.obtener(ruta, mtime_ns, codificacion) if codificacion else None
+        if comprimido:
+            etag = f'{etag[:-1]}-{codificacion}"'
+        validacion = self.cabeceras_validacion(ruta, etag, ultima_mod, variable)
+        if self.no_modificado(etag, mtime):
+            self.enviar_cabeceras(304, validacion)
+            return
+        try:
+            f = open(comprimido or ruta, "rb")
+        except OSError:
+            # El catálogo aún no sabe que se borró
+            self.send_error(404, "No encontrado")
+            return
+        with f:
+            tamano = os.fstat(f.fileno()).st_size
+            cabeceras = {"Content-Type": tipo, "Content-Length": str(tamano)}
+            if comprimido:
+                cabeceras["Content-Encoding"] = codificacion
+            cabeceras.update(validacion)
+            if tamano <= self.cache_paginas.max_entrada:
+                cuerpo = f.read()
+                self.cache_paginas.guardar(clave, firma, cuerpo, cabeceras)
+                self.enviar_cabeceras(200, cabeceras)
+                self.wfile.write(cuerpo)
+            else:
+                self.enviar_cabeceras(200, cabeceras)
+                self.copiar_archivo(f, 0, tamano)
+
+    def enviar_ocupado(self, motivo):
+        cuerpo = f"Servidor ocupado ({motivo}), vuelve a intentarlo en unos segundos.".encode("utf-8")
+        self.enviar_cabeceras(503, {"Retry-After": str(RETRY_AFTER),
+                                    "Content-Type": "text/plain; charset=utf-8",
+                                    "Content-Length": str(len(cuerpo))})
+        self.wfile.write(cuerpo)
+
+class ServidorPoolHilos(socketserver.TCPServer):
+    """TCPServer con un número fijo de hilos y una cola de conexiones acotada.
+
+    Si la cola está llena, el hilo que acepta contesta 503 con Retry-After y
+    cierra, así un pico de tráfico no crea hilos sin límite. Un hilo solo
+    atiende una conexión mientras tiene peticiones que leer: las conexiones
+    keep-alive ociosas esperan en un selector (el hilo vigía), que las
+    devuelve a la cola cuando llega otra petición y las cierra si pasan
+    TIEMPO_INACTIVO segundos sin ella.
+    """
+    def __init__(self, direccion, manejador, hilos=HILOS_POOL, cola=COLA_POOL,
+                 pila_kb=PILA_HILO_KB, bind_and_activate=True):
+        # Antes de super().__init__(): si bind falla, este llama a server_close()
+        self.cola = queue.Queue(maxsize=cola)
+        self.hilos = hilos
+        self.pila_kb = pila_kb
+        self.workers = []
+        self.aparcadas = queue.SimpleQueue()  # conexiones que pasan al vigía (None = terminar)
+        self.despertador = socket.socketpair()
+        for extremo in self.despertador:
+            extremo.setblocking(False)
+        self.hilo_vigia = None
+        super().__init__(direccion, manejador, bind_and_activate)
+
+    def arrancar_workers(self):
+        if self.workers:
+            return
+        anterior = threading.stack_size(self.pila_kb * 1024) if self.pila_kb else None
+        try:
+            for n in range(self.hilos):
+                t = threading.Thread(target=self.worker, name=f"pool-{n}", daemon=True)
+                t.start()
+                self.workers.append(t)
+            self.hilo_vigia = threading.Thread(target=self.vigia, name="pool-vigia", daemon=True)
+            self.hilo_vigia.start()
+        finally:
+            if anterior is not None:
+                threading.stack_size(anterior)
+
+    def serve_forever(self, poll_interval=0.5):
+        self.arrancar_workers()
+        super().serve_forever(poll_interval)
+
+    def worker(self):
+        while True:
+            request, client_address, handler = self.cola.get()
+            if request is None:
+                return
+            try:
+                if handler is None:
+                    handler = self.crear_manejador(request, client_address)
+                self.atender(handler)
+                if not handler.close_connection:
+                    self.aparcadas.put((request, client_address, handler))
+                    self.despertar()
+                    continue
+            except ConnectionError:
+                pass  # el cliente cerró (p. ej. una keep-alive ociosa): no es un error del servidor
+            except Exception:
+                self.handle_error(request, client_address)
+            self.cerrar(request, handler)
+
+    def crear_manejador(self, request, client_address):
+        # Como BaseRequestHandler.__init__, pero sin atender la conexión entera de una vez
+        handler = self.RequestHandlerClass.__new__(self.RequestHandlerClass)
+        handler.request = request
+        handler.client_address = client_address
+        handler.server = self
+        handler.setup()
+        handler.close_connection = True
+        return handler
+
+    def atender(self, handler):
+        """Contesta las peticiones que ya han llegado por la conexión de handler."""
+        handler.handle_one_request()
+        while not handler.close_connection and self.hay_peticion(handler):
+            handler.handle_one_request()
+
+    @staticmethod
+    def hay_peticion(handler):
+        """True si ya hay datos de otra petición (en el buffer de rfile o en el socket), sin esperar."""
+        handler.connection.settimeout(0)
+        try:
+            return bool(handler.rfile.peek(1))
+        except OSError:
+            return True  # que la lea handle_one_request y cierre si hace falta
+        finally:
+            handler.connection.settimeout(handler.timeout)
+
+    def cerrar(self, request, handler):
+        if handler is not None:
+            try:
+                handler.finish()
+            except OSError:
+                pass
+        self.shutdown_request(request)
+
+    def despertar(self):
+        try:
+            self.despertador[1].send(b"\0")
+        except OSError:
+            pass  # el buffer lleno ya basta para despertarlo
+
+    def vigia(self):
+        selector = selectors.DefaultSelector()
+        selector.register(self.despertador[0], selectors.EVENT_READ)
+        limites = {}  # socket -> instante en que se cierra si sigue ociosa
+        try:
+            while True:
+                espera = max(0, min(limites.values()) - time.monotonic()) if limites else None
+                for clave, _ in selector.select(espera):
+                    if clave.fileobj is self.despertador[0]:
+                        try:
+                            self.despertador[0].recv(4096)
+                        except OSError:
+                            pass
+                        continue
+                    selector.unregister(clave.fileobj)
+                    del limites[clave.fileobj]
+                    self.encolar(clave.fileobj, *clave.data)
+                while True:
+                    try:
+                        aparcada = self.aparcadas.get_nowait()
+                    except queue.Empty:
+                        break
+                    if aparcada is None:
+                        return
+                    request, client_address, handler = aparcada
+                    selector.register(request, selectors.EVENT_READ, (client_address, handler))
+                    limites[request] = time.monotonic() + TIEMPO_INACTIVO
+                ahora = time.monotonic()
+                for request in [r for r, limite in limites.items() if limite <= ahora]:
+                    handler = selector.unregister(request).data[1]
+                    del limites[request]
+                    self.cerrar(request, handler)
+        finally:
+            for clave in list(selector.get_map().values()):
+                if clave.fileobj is not self.despertador[0]:
+                    self.cerrar(clave.fileobj, clave.data[1])
+            selector.close()
+            for extremo in self.despertador:
+                extremo.close()
+
+    def encolar(self, request, client_address, handler):
+        try:
+            self.cola.put_nowait((request, client_address, handler))
+        except queue.Full:
+            self.rechazar(request)
+            self.cerrar(request, handler)
+
+    def process_request(self, request, client_address):
+        try:
+            self.cola.put_nowait((request, client_address, None))
+        except queue.Full:
+            self.rechazar(request)
+            self.shutdown_request(request)
+
+    def rechazar(self, request):
+        cuerpo = b"Servidor ocupado, vuelve a intentarlo en unos segundos.\n"
+        respuesta = (b"HTTP/1.1 503 Service Unavailable\r\n"
+                     b"Retry-After: " + str(RETRY_AFTER).encode() + b"\r\n"
+                     b"Content-Type: text/plain; charset=utf-8\r\n"
+                     b"Content-Length: " + str(len(cuerpo)).encode() + b"\r\n"
+                     b"Connection: close\r\n\r\n" + cuerpo)
+        try:
+            request.settimeout(1)
+            request.sendall(respuesta)
+        except OSError:
+            pass
+
+    def server_close(self):
+        super().server_close()
+        # Las conexiones que esperaban en la cola se cierran; así caben los avisos de salida
+        while True:
+            try:
+                request, _, handler = self.cola.get_nowait()
+            except queue.Empty:
+                break
+            if request is not None:
+                self.cerrar(request, handler)
+        for _ in self.workers:
+            try:
+                self.cola.put_nowait((None, None, None))
+            except queue.Full:
+                break
+        if self.hilo_vigia is not None:
+            self.aparcadas.put(None)
+            self.despertar()
+        else:
+            for extremo in self.despertador:
+                extremo.close()
+
+def crear_socket_escucha(direccion, reuseport=False):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuseport:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind(direccion)
+    return sock
+
+def prefork(direccion, procesos, reuseport, crear):
+    """Proceso maestro: abre el puerto, lanza procesos workers y relanza los que caen.
+
+    crear(sock) crea, ya en el worker, el servidor que escucha en sock. Sin
+    reuseport todos los workers aceptan del mismo socket heredado; con
+    reuseport cada worker abre el suyo y el kernel reparte las conexiones.
+    """
+    reuseport = reuseport and hasattr(socket, "SO_REUSEPORT")
+    # Con SO_REUSEPORT el maestro solo reserva el puerto: sin listen() no recibe conexiones
+    maestro = crear_socket_escucha(direccion, reuseport)
+    if not reuseport:
+        maestro.listen(128)
+        maestro.setblocking(False)
+    workers = {}
+
+    def lanzar():
+        pid = os.fork()
+        if pid:
+            workers[pid] = time.monotonic()
+            return
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        codigo = 1
+        try:
+            if reuseport:
+                sock = crear_socket_escucha(direccion, True)
+                sock.listen(128)
+                maestro.close()
+            else:
+                sock = maestro
+            crear(sock).serve_forever()
+            codigo = 0
+        except KeyboardInterrupt:
+            codigo = 0
+        except Exception:
+            traceback.print_exc()
+        finally:
+            os._exit(codigo)
+
+    def terminar(signum, frame):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, terminar)
+    for _ in range(procesos):
+        lanzar()
+    try:
+        while True:
+            pid, estado = os.wait()
+            inicio = workers.pop(pid, None)
+            if inicio is None:
+                continue
+            print(f"Worker {pid} terminó (estado {estado}), relanzando...")
+            if time.monotonic() - inicio < 1:
+                time.sleep(1)  # evita un bucle de relanzamientos si el worker cae al arrancar
+            lanzar()
+    except KeyboardInterrupt:
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in workers:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
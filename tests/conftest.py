@@ -0,0 +1,19 @@
+import importlib.util
+import os
+import shutil
+import sys
+
+import pytest
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+
+@pytest.fixture(scope="module")
+def ftp(tmp_path_factory):
+    """El script FTP importado desde una copia: crea sus carpetas y bases de datos junto a ella."""
+    carpeta = tmp_path_factory.mktemp("ftp")
+    ruta = shutil.copy(os.path.join(RAIZ, "apacheFTP v0.0.24.py"), carpeta / "apache_ftp.py")
+    spec = importlib.util.spec_from_file_location("apache_ftp", ruta)
+    modulo = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(modulo)
+    return modulo
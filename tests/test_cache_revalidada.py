@@ -0,0 +1,55 @@
+import threading
+import time
+
+from comun import CacheRevalidada
+
+class Contador:
+    """construir() lento que cuenta sus llamadas y devuelve (versión, llamada)."""
+    def __init__(self, version, espera=0.2):
+        self.version = version
+        self.espera = espera
+        self.llamadas = 0
+
+    def __call__(self):
+        self.llamadas += 1
+        numero = self.llamadas
+        time.sleep(self.espera)
+        return (self.version[0], numero)
+
+def en_paralelo(cache, clave, construir, n=8):
+    resultados = []
+    hilos = [threading.Thread(target=lambda: resultados.append(cache.obtener(clave, construir)))
+             for _ in range(n)]
+    for hilo in hilos:
+        hilo.start()
+    for hilo in hilos:
+        hilo.join()
+    return resultados
+
+def test_sin_copia_una_sola_construccion():
+    version = [1]
+    construir = Contador(version)
+    cache = CacheRevalidada(60, 10, lambda: version[0])
+    assert en_paralelo(cache, "k", construir) == [(1, 1)] * 8
+    assert construir.llamadas == 1
+
+def test_cambio_de_version_espera_la_reconstruccion():
+    version = [1]
+    construir = Contador(version)
+    cache = CacheRevalidada(60, 10, lambda: version[0])
+    cache.obtener("k", construir)
+    version[0] = 2
+    # Ninguna petición recibe la copia de la versión anterior
+    assert en_paralelo(cache, "k", construir) == [(2, 2)] * 8
+    assert construir.llamadas == 2
+
+def test_ttl_caducado_sirve_la_copia_y_reconstruye_en_fondo():
+    version = [1]
+    construir = Contador(version, espera=0.1)
+    cache = CacheRevalidada(0.05, 10, lambda: version[0])
+    cache.obtener("k", construir)
+    time.sleep(0.1)
+    assert en_paralelo(cache, "k", construir) == [(1, 1)] * 8
+    time.sleep(0.3)
+    assert construir.llamadas == 2
+    assert cache.obtener("k", construir) == (1, 2)
@@ -0,0 +1,38 @@
+import hashlib
+
+import pytest
+
+def test_hash_y_verificacion(ftp):
+    guardado = ftp.hash_password("secreta")
+    assert guardado.startswith("scrypt$")
+    assert ftp.hash_password("secreta") != guardado  # sal distinta cada vez
+    assert ftp.verificar_password("secreta", guardado) == (True, None)
+    assert ftp.verificar_password("otra", guardado) == (False, None)
+
+def test_sha256_antiguo_se_actualiza(ftp):
+    antiguo = hashlib.sha256(b"secreta").hexdigest()
+    correcta, nuevo = ftp.verificar_password("secreta", antiguo)
+    assert correcta and nuevo.startswith("scrypt$")
+    assert ftp.verificar_password("secreta", nuevo) == (True, None)
+    assert ftp.verificar_password("otra", antiguo) == (False, None)
+
+def test_parametros_antiguos_se_actualizan(ftp):
+    *_, sal, clave = ftp.hash_password("secreta").split("$")
+    sal = bytes.fromhex(sal)
+    clave = hashlib.scrypt(b"secreta", salt=sal, n=2 ** 10, r=8, p=1, dklen=len(clave) // 2).hex()
+    correcta, nuevo = ftp.verificar_password("secreta", f"scrypt${2 ** 10}$8$1${sal.hex()}${clave}")
+    assert correcta and nuevo is not None
+
+@pytest.mark.parametrize("guardado", [
+    "scrypt$",
+    "scrypt$16384$8$1$00",
+    "scrypt$a$8$1$00$00",
+    "scrypt$3$8$1$00$00",
+    "scrypt$16384$8$1$zz$00",
+    "scrypt$16384$8$1$00$ñ",
+    "scrypt$16384$8$1$00$",
+    "scrypt$99999999999999999999$8$1$00$00",
+])
+def test_registro_mal_formado_es_incorrecta(ftp, guardado, caplog):
+    assert ftp.verificar_password("secreta", guardado) == (False, None)
+    assert "mal formado" in caplog.text
@@ -0,0 +1,56 @@
+import socket
+import threading
+from http.server import BaseHTTPRequestHandler
+
+from comun import ServidorPoolHilos
+
+class Lento(BaseHTTPRequestHandler):
+    dentro = threading.Event()
+    seguir = threading.Event()
+
+    def do_GET(self):
+        Lento.dentro.set()
+        Lento.seguir.wait(10)
+        self.send_response(200)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"ok")
+
+    def log_message(self, *args):
+        pass
+
+def pedir(puerto):
+    s = socket.create_connection(("127.0.0.1", puerto), timeout=10)
+    s.sendall(b"GET / HTTP/1.0\r\n\r\n")
+    return s
+
+def leer(s):
+    datos = b""
+    while True:
+        trozo = s.recv(4096)
+        if not trozo:
+            return datos
+        datos += trozo
+
+def test_cola_llena_responde_503():
+    servidor = ServidorPoolHilos(("127.0.0.1", 0), Lento, hilos=1, cola=1)
+    hilo = threading.Thread(target=servidor.serve_forever, daemon=True)
+    hilo.start()
+    puerto = servidor.server_address[1]
+    try:
+        ocupada = pedir(puerto)
+        assert Lento.dentro.wait(10)
+        en_cola = pedir(puerto)
+        rechazada = pedir(puerto)
+        respuesta = leer(rechazada)
+        assert respuesta.startswith(b"HTTP/1.1 503 ")
+        assert b"Retry-After: " in respuesta
+        Lento.seguir.set()
+        assert leer(ocupada).startswith(b"HTTP/1.0 200 ")
+        assert leer(en_cola).startswith(b"HTTP/1.0 200 ")
+        for s in (ocupada, en_cola, rechazada):
+            s.close()
+    finally:
+        Lento.seguir.set()
+        servidor.shutdown()
+        servidor.server_close()
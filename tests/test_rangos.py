@@ -0,0 +1,23 @@
+from comun import parsear_rangos
+
+def test_rango_simple():
+    assert parsear_rangos("bytes=0-99", 1000) == [(0, 99)]
+
+def test_rango_abierto_y_sufijo():
+    assert parsear_rangos("bytes=900-", 1000) == [(900, 999)]
+    assert parsear_rangos("bytes=-100", 1000) == [(900, 999)]
+    assert parsear_rangos("bytes=-5000", 1000) == [(0, 999)]
+
+def test_varios_rangos():
+    assert parsear_rangos("bytes=0-9, 20-29,-5", 100) == [(0, 9), (20, 29), (95, 99)]
+
+def test_fin_recortado_al_tamano():
+    assert parsear_rangos("bytes=10-5000", 100) == [(10, 99)]
+
+def test_fuera_del_archivo_es_416():
+    assert parsear_rangos("bytes=1000-", 1000) == []
+    assert parsear_rangos("bytes=-0", 1000) == []
+
+def test_cabecera_invalida_se_ignora():
+    for cabecera in ("items=0-1", "bytes=abc", "bytes=5-1", "bytes=x-1", "bytes=-y"):
+        assert parsear_rangos(cabecera, 1000) is None
@@ -0,0 +1,29 @@
+import os
+
+import pytest
+
+from comun import dentro_de, ruta_uri
+
+def test_dentro_de(tmp_path):
+    base = tmp_path / "base"
+    (base / "sub").mkdir(parents=True)
+    assert dentro_de(str(base / "sub" / "a.html"), str(base))
+    assert dentro_de(str(base), str(base))
+    assert not dentro_de(str(base / ".." / "otra"), str(base))
+
+def test_prefijo_no_basta(tmp_path):
+    (tmp_path / "base").mkdir()
+    (tmp_path / "base2").mkdir()
+    assert not dentro_de(str(tmp_path / "base2" / "a"), str(tmp_path / "base"))
+
+def test_enlace_hacia_fuera(tmp_path):
+    base = tmp_path / "base"
+    base.mkdir()
+    (tmp_path / "secreto").mkdir()
+    os.symlink(tmp_path / "secreto", base / "enlace")
+    assert not dentro_de(str(base / "enlace" / "a"), str(base))
+
+def test_ruta_uri(tmp_path):
+    assert ruta_uri(str(tmp_path), "/a/b.mako") == str(tmp_path / "a" / "b.mako")
+    with pytest.raises(ValueError):
+        ruta_uri(str(tmp_path), "/../fuera.mako")
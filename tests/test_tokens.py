@@ -0,0 +1,51 @@
+import secrets
+
+def test_firma_y_lectura(ftp):
+    token = ftp.firmar_token("ana")
+    usuario, expira, jti = ftp.leer_token(token)
+    assert usuario == "ana" and len(jti) == 16
+
+def test_token_alterado(ftp):
+    token = ftp.firmar_token("ana")
+    partes = token.split(".")
+    partes[1] = ftp.b64_codificar(b"root")
+    assert ftp.leer_token(".".join(partes)) is None
+    assert ftp.leer_token(token[:-2]) is None
+    assert ftp.leer_token("basura") is None
+
+def test_token_caducado(ftp, monkeypatch):
+    monkeypatch.setattr(ftp, "SESION_MAXIMA", -10)
+    assert ftp.leer_token(ftp.firmar_token("ana")) is None
+
+def test_revocacion(ftp, monkeypatch):
+    monkeypatch.setattr(ftp, "SESIONES_FIRMADAS", True)
+    token = ftp.firmar_token("ana")
+    assert ftp.buscar_session(token) == "ana"
+    ftp.borrar_session(token)
+    assert ftp.buscar_session(token) is None
+    # Otro proceso con la misma base de datos también la ve revocada
+    otro = ftp.RevocacionesSesion(ftp.REVOCADAS.ruta)
+    assert otro.contiene(ftp.leer_token(token)[2])
+
+def test_rotacion_de_clave(ftp):
+    token = ftp.firmar_token("ana")
+    ftp.CLAVES_SESION.rotar()
+    ftp.CLAVES_SESION.claves = []  # que se vuelva a leer el archivo sin esperar CLAVES_REFRESCO
+    assert ftp.CLAVES_SESION.activa()[0] != token.split(".")[0]
+    assert ftp.leer_token(token)[0] == "ana"
+
+def test_claves_mal_formadas(ftp, tmp_path):
+    valida = secrets.token_hex(ftp.CLAVE_SESION_BYTES)
+    ruta = tmp_path / "claves"
+    ruta.write_text(f"zz\n{valida[:-2]}\n{valida}\n", encoding="utf-8")
+    claves = ftp.ClavesSesion(str(ruta))
+    assert claves.activa()[1].hex() == valida
+    assert len(claves.claves) == 1
+
+def test_sin_claves_validas_se_genera_una(ftp, tmp_path):
+    ruta = tmp_path / "claves"
+    ruta.write_text("no es hexadecimal\n", encoding="utf-8")
+    claves = ftp.ClavesSesion(str(ruta))
+    _, clave = claves.activa()
+    assert len(clave) == ftp.CLAVE_SESION_BYTES
+    assert ruta.read_text(encoding="utf-8").split() == [clave.hex()]
@@ -4,9 +4,23 @@ from mako.template import Template
 from urllib.parse import urlparse, parse_qs
 import os
 import mimetypes
+import threading
+import shutil
+import secrets
+
+from comun import (ManejadorBase, CacheTemplates, LookupSitio, ruta_modulo, limpiar_modulos_viejos,
+                   calcular_etag, politica_cache, parsear_rangos, MAX_RANGOS,
+                   PoolRender, RenderTimeout, RenderOcupado)
+
+def preguntar(mensaje):
+    """input() que devuelve "" si stdin ya se acabó (scripts que solo contestan las primeras preguntas)."""
+    try:
+        return input(mensaje)
+    except EOFError:
+        return ""
 
 def pedir_directorio(mensaje, defecto):
-    ruta = input(mensaje).strip()
+    ruta = preguntar(mensaje).strip()
     if not ruta:
         ruta = defecto
     return os.path.abspath(ruta)
@@ -14,19 +28,85 @@ def pedir_directorio(mensaje, defecto):
 WEB_ROOT = pedir_directorio("Carpeta base para servir archivos web (.mako, .html): ", os.getcwd())
 BASE_DIR_1 = pedir_directorio("Introduce la PRIMERA carpeta de archivos para leer/escribir: ", os.getcwd())
 BASE_DIR_2 = pedir_directorio("Introduce la SEGUNDA carpeta de archivos (opcional): ", os.getcwd() + "_alt")
+MODULOS_DIR = os.path.abspath(os.getcwd() + "_mako_modulos")  # templates compilados; se pregunta al arrancar
 
 BASE_DIRS = {
     "principal": BASE_DIR_1,
     "alternativo": BASE_DIR_2
 }
 
+MAX_TEMPLATES = 256           # templates .mako compilados que se mantienen en memoria
+FRANJAS_CANDADOS = 64         # locks entre los que se reparten los archivos que se escriben
+
 def safe_join(base, *paths):
     final_path = os.path.abspath(os.path.join(base, *paths))
     if not final_path.startswith(base):
         raise ValueError("Intento de acceso fuera del directorio permitido.")
     return final_path
 
-class MakoReadWriteHandler(http.server.SimpleHTTPRequestHandler):
+# Locks fijos entre los que se reparten los archivos por hash de su ruta
+_CANDADOS = [threading.Lock() for _ in range(FRANJAS_CANDADOS)]
+
+def candado_archivo(ruta):
+    """Lock del archivo: dos POST sobre el mismo archivo se escriben de uno en uno.
+
+    No se guarda un lock por ruta escrita; dos archivos distintos pueden
+    compartir franja, lo que solo hace esperar al segundo.
+    """
+    return _CANDADOS[hash(os.path.realpath(ruta)) % len(_CANDADOS)]
+
+def escribir_atomico(ruta, contenido):
+    """Escribe en un temporal y lo renombra: quien lea ve el archivo viejo o el nuevo, nunca uno a medias.
+
+    Como open(ruta, "w"), un enlace simbólico se sigue y se reescribe su
+    destino, no el enlace. Un archivo con varios enlaces duros, en cambio,
+    queda separado: el rename crea un inodo nuevo y los otros nombres
+    siguen viendo el contenido anterior.
+    """
+    ruta = os.path.realpath(ruta)
+    tmp = f"{ruta}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(contenido)
+        if os.path.exists(ruta):
+            shutil.copymode(ruta, tmp)
+        os.replace(tmp, ruta)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+def compilar_template(ruta, st):
+    """Compila el .mako reutilizando, si existe, su módulo ya generado en MODULOS_DIR."""
+    modulo = ruta_modulo(MODULOS_DIR, ruta, st)
+    if not os.path.exists(modulo):
+        limpiar_modulos_viejos(modulo)
+    relativa = os.path.relpath(ruta, WEB_ROOT)
+    if relativa.split(os.sep)[0] == "..":
+        return Template(filename=ruta, module_filename=modulo)
+    return Template(filename=ruta, uri="/" + relativa.replace(os.sep, "/"), lookup=LOOKUP_WEB,
+                    module_filename=modulo)
+
+CACHE_TEMPLATES = CacheTemplates(MAX_TEMPLATES, compilar_template)
+LOOKUP_WEB = LookupSitio(WEB_ROOT, CACHE_TEMPLATES)
+
+def iniciar_proceso_render():
+    """Inicializador de cada proceso del pool de render; devuelve la caché con la que renderiza."""
+    global CACHE_TEMPLATES, LOOKUP_WEB
+    # Caché y lookup nuevos: los heredados del fork pueden tener locks tomados por otro hilo
+    CACHE_TEMPLATES = CacheTemplates(MAX_TEMPLATES, compilar_template)
+    LOOKUP_WEB = LookupSitio(WEB_ROOT, CACHE_TEMPLATES)
+    return CACHE_TEMPLATES
+
+POOL_RENDER = None  # se crea al arrancar si se piden procesos de render
+
+def renderizar(ruta, **contexto):
+    """Renderiza en POOL_RENDER si está activo; si no, en el hilo actual."""
+    if POOL_RENDER is None:
+        return str(CACHE_TEMPLATES.obtener(ruta).render(**contexto))
+    return POOL_RENDER.render(ruta, contexto)
+
+class MakoReadWriteHandler(ManejadorBase):
     def translate_path(self, path):
         path = path.split('?',1)[0]
         path = path.split('#',1)[0]
@@ -47,20 +127,90 @@ class MakoReadWriteHandler(http.server.SimpleHTTPRequestHandler):
 
     def serve_static(self, file_path):
         try:
+            f = open(file_path, "rb")
+        except Exception as e:
+            self.enviar_html(f"<pre>No se pudo servir el archivo: {e}</pre>", 404)
+            return
+        with f:
             mime_type, _ = mimetypes.guess_type(file_path)
             # Forzar el MIME correcto para .mp4
             ext = os.path.splitext(file_path)[1].lower()
             if ext == '.mp4':
                 mime_type = "video/mp4"
-            self.send_response(200)
-            self.send_header("Content-Type", mime_type or "application/octet-stream")
-            self.end_headers()
-            with open(file_path, "rb") as f:
-                self.wfile.write(f.read())
-        except Exception as e:
-            self.send_response(404)
-            self.end_headers()
-            self.wfile.write(f"<pre>No se pudo servir el archivo: {e}</pre>".encode("utf-8"))
+            tipo = mime_type or "application/octet-stream"
+            st = os.fstat(f.fileno())
+            tamano = st.st_size
+            etag = calcular_etag(st)
+            ultima_mod = self.date_time_string(int(st.st_mtime))
+            if self.no_modificado(etag, st.st_mtime):
+                self.enviar_no_modificado(file_path, etag, ultima_mod)
+                return
+            rangos = None
+            if self.headers.get("Range") and tamano > 0 and self.if_range_vale(etag, ultima_mod):
+                rangos = parsear_rangos(self.headers["Range"], tamano)
+                if rangos and len(rangos) > MAX_RANGOS:
+                    rangos = None
+            if rangos == []:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{tamano}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            if not rangos:
+                self.send_response(200)
+                self.send_header("Content-Type", tipo)
+                self.send_header("Content-Length", str(tamano))
+                self.send_header("Accept-Ranges", "bytes")
+                self.enviar_validadores(file_path, etag, ultima_mod)
+                self.end_headers()
+                self.copiar_archivo(f, 0, tamano)
+            elif len(rangos) == 1:
+                inicio, fin = rangos[0]
+                self.send_response(206)
+                self.send_header("Content-Type", tipo)
+                self.send_header("Content-Range", f"bytes {inicio}-{fin}/{tamano}")
+                self.send_header("Content-Length", str(fin - inicio + 1))
+                self.send_header("Accept-Ranges", "bytes")
+                self.enviar_validadores(file_path, etag, ultima_mod)
+                self.end_headers()
+                self.copiar_archivo(f, inicio, fin - inicio + 1)
+            else:
+                self.enviar_multirango(f, file_path, tipo, tamano, rangos, etag, ultima_mod)
+
+    def if_range_vale(self, etag, ultima_mod):
+        """Sin If-Range, o si coincide con el archivo actual, se respeta el Range."""
+        if_range = self.headers.get("If-Range")
+        return not if_range or if_range.strip() in (etag, ultima_mod)
+
+    def enviar_validadores(self, ruta, etag, ultima_mod):
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", ultima_mod)
+        self.send_header("Cache-Control", politica_cache(ruta))
+
+    def enviar_no_modificado(self, ruta, etag, ultima_mod):
+        self.send_response(304)
+        self.enviar_validadores(ruta, etag, ultima_mod)
+        self.end_headers()
+
+    def enviar_multirango(self, f, ruta, tipo, tamano, rangos, etag, ultima_mod):
+        """206 multipart/byteranges: cada parte se lee del disco al enviarla."""
+        separador = secrets.token_hex(12)
+        cabeceras = [(f"\r\n--{separador}\r\nContent-Type: {tipo}\r\n"
+                      f"Content-Range: bytes {inicio}-{fin}/{tamano}\r\n\r\n").encode("latin-1")
+                     for inicio, fin in rangos]
+        cierre = f"\r\n--{separador}--\r\n".encode("latin-1")
+        longitud = sum(len(c) for c in cabeceras) + len(cierre)
+        longitud += sum(fin - inicio + 1 for inicio, fin in rangos)
+        self.send_response(206)
+        self.send_header("Content-Type", f"multipart/byteranges; boundary={separador}")
+        self.send_header("Content-Length", str(longitud))
+        self.send_header("Accept-Ranges", "bytes")
+        self.enviar_validadores(ruta, etag, ultima_mod)
+        self.end_headers()
+        for cabecera, (inicio, fin) in zip(cabeceras, rangos):
+            self.wfile.write(cabecera)
+            self.copiar_archivo(f, inicio, fin - inicio + 1)
+        self.wfile.write(cierre)
 
     def do_POST(self):
         parsed = urlparse(self.path)
@@ -97,8 +247,8 @@ class MakoReadWriteHandler(http.server.SimpleHTTPRequestHandler):
                 if archivo:
                     try:
                         ruta = safe_join(base_dir, archivo)
-                        with open(ruta, "w", encoding="utf-8") as f:
-                            f.write(contenido)
+                        with candado_archivo(ruta):
+                            escribir_atomico(ruta, contenido)
                         result["escribir_ok"] = True
                         result["archivo_escribir"] = archivo
                         result["ubicacion"] = ubicacion
@@ -112,24 +262,45 @@ class MakoReadWriteHandler(http.server.SimpleHTTPRequestHandler):
 
     def serve_mako(self, file_path, params, result):
         try:
-            template = Template(filename=file_path)
-            html = template.render(params=params, result=result, ubicaciones=BASE_DIRS.keys(), cssfile="estilos.css")
-            self.send_response(200)
-            self.send_header("Content-Type", "text/html; charset=utf-8")
-            self.end_headers()
-            self.wfile.write(html.encode("utf-8"))
+            html = renderizar(file_path, params=params, result=result, ubicaciones=list(BASE_DIRS.keys()), cssfile="estilos.css")
+        except RenderTimeout as e:
+            self.send_error(504, f"Template demasiado lento: {e}")
+            return
+        except RenderOcupado as e:
+            self.enviar_ocupado(str(e))
+            return
         except Exception as e:
-            self.send_response(500)
-            self.end_headers()
-            self.wfile.write(f"<pre>Error ejecutando Mako: {e}</pre>".encode("utf-8"))
+            self.enviar_html(f"<pre>Error ejecutando Mako: {e}</pre>", 500)
+            return
+        self.enviar_html(html)
 
 try:
     PORT = int(input("Elige tu puerto: ") or "8000")
 except ValueError:
     PORT = 8000
 
-with socketserver.TCPServer(("", PORT), MakoReadWriteHandler) as httpd:
-    print(f"Servidor corriendo en el puerto {PORT}")
+# Concurrente: un hilo por conexión, así una descarga lenta no bloquea al resto
+concurrente = preguntar("¿Atender varias peticiones a la vez? (S/n): ").strip().lower() != "n"
+ServidorClase = socketserver.ThreadingTCPServer if concurrente else socketserver.TCPServer
+
+# Las preguntas nuevas van después de las de siempre: así los scripts que ya
+# contestan por stdin siguen respondiendo a las mismas, y las que no contestan
+# se quedan con el valor por defecto.
+MODULOS_DIR = pedir_directorio(f"Carpeta para los templates compilados [{MODULOS_DIR}]: ", MODULOS_DIR)
+
+# Render aislado: los .mako se ejecutan en procesos aparte con límites de tiempo, CPU y memoria
+if hasattr(os, "fork"):
+    try:
+        procesos_render = int(preguntar("Procesos para renderizar Mako aislado (0 = en el propio hilo): ") or "0")
+    except ValueError:
+        procesos_render = 0
+    if procesos_render > 0:
+        POOL_RENDER = PoolRender(procesos_render, iniciar_proceso_render)
+        POOL_RENDER.arrancar()
+
+with ServidorClase(("", PORT), MakoReadWriteHandler) as httpd:
+    httpd.daemon_threads = True
+    print(f"Servidor corriendo en el puerto {PORT} ({'concurrente' if concurrente else 'una petición a la vez'})")
     print(f"Web root: {WEB_ROOT}")
     print(f"Ubicaciones de archivos:")
     for nombre, ruta in BASE_DIRS.items():